@@ -0,0 +1,65 @@
+"""
+Compares the per-call overhead of running a coroutine task body with a fresh
+`asyncio.run` loop against the persistent worker loop used by `register_task`.
+Tasks are called in-process, so no broker is needed.
+
+    python benchmarks/async_task_overhead.py
+"""
+import asyncio
+import os
+import time
+from celery import Celery
+from unboil.celery import register_task, worker_event_loop
+
+
+CALLS = int(os.environ.get("CALLS", "5000"))
+
+app = Celery("benchmark")
+
+
+class Pool:
+    # stands in for a loop-bound connection pool (AsyncEngine, aiohttp session)
+    instance: "Pool | None" = None
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.created = 1
+
+    @classmethod
+    async def get(cls) -> "Pool":
+        loop = asyncio.get_running_loop()
+        if cls.instance is None or cls.instance.loop is not loop:
+            await asyncio.sleep(0.001)  # connection setup
+            created = 0 if cls.instance is None else cls.instance.created
+            cls.instance = cls()
+            cls.instance.created += created
+        return cls.instance
+
+
+async def body(x: int) -> int:
+    pool = await Pool.get()
+    await asyncio.sleep(0)
+    return x + pool.created
+
+
+per_task = register_task(app=app, event_loop="task", name="bench.per_task")(body)
+per_worker = register_task(app=app, event_loop="worker", name="bench.per_worker")(body)
+
+
+def run(task, label: str) -> None:
+    Pool.instance = None
+    start = time.perf_counter()
+    for i in range(CALLS):
+        task(i)
+    elapsed = time.perf_counter() - start
+    created = Pool.instance.created if Pool.instance else 0
+    print(
+        f"{label:>10}: {elapsed / CALLS * 1e6:8.1f}us/task  "
+        f"pools created={created}"
+    )
+
+
+if __name__ == "__main__":
+    run(per_task, "asyncio.run")
+    run(per_worker, "worker loop")
+    worker_event_loop.close()
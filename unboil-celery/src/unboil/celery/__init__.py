@@ -1,2 +1,5 @@
 from .typed import *
-from .cached import *
\ No newline at end of file
+from .cached import *
+from .batched import *
+from .metrics import *
+from .local import *
\ No newline at end of file
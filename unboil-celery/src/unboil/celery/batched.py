@@ -0,0 +1,194 @@
+import functools
+import inspect
+import logging
+from dataclasses import dataclass, field
+from celery import Celery, current_task, shared_task, signals
+from celery.utils.imports import symbol_by_name
+from celery.utils.time import timezone
+from celery.worker.request import create_request_cls
+from celery.worker.state import task_ready, task_reserved
+from celery.worker.strategy import hybrid_to_proto2, proto1_to_proto2
+from kombu.asynchronous.timer import to_timestamp
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Generic,
+    ParamSpec,
+    Sequence,
+    TypeVar,
+    cast,
+)
+from .typed import TypedTask, worker_event_loop
+
+__all__ = [
+    "BatchItem",
+    "BatchedTask",
+    "register_batched_task",
+]
+
+
+T = TypeVar("T")
+P = ParamSpec("P")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(kw_only=True)
+class BatchItem(Generic[P]):
+    id: str | None
+    args: tuple = ()
+    kwargs: dict[str, Any] = field(default_factory=dict)
+
+
+class BatchedTask(TypedTask[P]):
+
+    # buffered requests are not acked yet, so the worker holds at most its prefetch
+    # count (prefetch multiplier x concurrency) of them and larger batches only
+    # ever flush on flush_interval
+    flush_every: int = 100
+    flush_interval: float = 1.0
+    run_batch: Callable[[list[BatchItem[P]]], Sequence[Any]]
+
+    def start_strategy(self, app: Celery, consumer: Any, **kwargs: Any) -> Callable[..., None]:
+        # replaces celery's default strategy: requests are buffered here and
+        # executed together instead of being handed to the pool one by one
+        hostname = consumer.hostname
+        eventer = consumer.event_dispatcher
+        connection_errors = consumer.connection_errors
+        revoked_tasks = consumer.controller.state.revoked
+        Req = create_request_cls(
+            symbol_by_name(self.Request), self, consumer.pool, hostname, eventer, app=app,
+        )
+        buffer: list[Any] = []
+        prefetch_count = consumer.initial_prefetch_count
+        if prefetch_count and self.flush_every > prefetch_count:
+            logger.warning(
+                "%s flushes every %d tasks but the worker prefetches only %d, so batches flush on the interval",
+                self.name, self.flush_every, prefetch_count,
+            )
+        if not consumer.disable_rate_limits and consumer.task_buckets[self.name] is not None:
+            logger.warning("%s is batched, so its rate limit is not applied", self.name)
+
+        def flush() -> None:
+            if not buffer:
+                return
+            requests = buffer[:]
+            buffer.clear()
+            if not self.acks_late:
+                for req in requests:
+                    req.acknowledge()
+            items = [BatchItem(id=req.id, args=tuple(req.args), kwargs=dict(req.kwargs)) for req in requests]
+            consumer.pool.apply_async(
+                _execute_batch,
+                args=(self, items),
+                callback=functools.partial(_on_batch_done, self, requests),
+            )
+
+        def buffer_request(req: Any) -> None:
+            buffer.append(req)
+            if len(buffer) >= self.flush_every:
+                flush()
+
+        def apply_eta_request(req: Any) -> None:
+            consumer.qos.decrement_eventually()
+            task_reserved(req)
+            buffer_request(req)
+
+        def task_message_handler(message, body, ack, reject, callbacks, **_: Any) -> None:
+            if body is None and "args" not in message.payload:
+                body, headers, decoded, utc = (
+                    message.body, message.headers, False, app.uses_utc_timezone(),
+                )
+            elif "args" in message.payload:
+                body, headers, decoded, utc = hybrid_to_proto2(message, message.payload)
+            else:
+                body, headers, decoded, utc = proto1_to_proto2(message, body)
+            req = Req(
+                message,
+                on_ack=ack, on_reject=reject, app=app, hostname=hostname,
+                eventer=eventer, task=self, connection_errors=connection_errors,
+                body=body, headers=headers, decoded=decoded, utc=utc,
+            )
+            if (req.expires or req.id in revoked_tasks) and req.revoked():
+                return
+            signals.task_received.send(sender=consumer, request=req)
+            if req.eta:
+                # like the default strategy, the timer holds the request until it is due
+                try:
+                    if req.utc:
+                        eta = to_timestamp(timezone.to_system(req.eta))
+                    else:
+                        eta = to_timestamp(req.eta, app.timezone)
+                except (OverflowError, ValueError):
+                    logger.exception("Couldn't convert ETA %r to timestamp for %s", req.eta, req.id)
+                    req.reject(requeue=False)
+                    return
+                consumer.qos.increment_eventually()
+                consumer.timer.call_at(eta, apply_eta_request, (req,), priority=6)
+                return
+            task_reserved(req)
+            if callbacks:
+                for callback in callbacks:
+                    callback(req)
+            buffer_request(req)
+
+        consumer.timer.call_repeatedly(self.flush_interval, flush)
+        return task_message_handler
+
+
+def register_batched_task(
+    app: Celery | None = None,
+    flush_every: int = 100,
+    flush_interval: float = 1.0,
+    **kwargs,
+) -> Callable[[Callable[[list[BatchItem[P]]], Sequence[T] | Awaitable[Sequence[T]]]], BatchedTask[P]]:
+
+    def decorator(main: Callable[[list[BatchItem[P]]], Sequence[T] | Awaitable[Sequence[T]]]) -> BatchedTask[P]:
+        if not inspect.iscoroutinefunction(main):
+            run_batch = cast(Callable[[list[BatchItem[P]]], Sequence[T]], main)
+        else:
+            def async_caller(items: list[BatchItem[P]]) -> Sequence[T]:
+                return worker_event_loop.run(main(items))
+            run_batch = functools.wraps(main)(async_caller)
+
+        # calling the task directly or eagerly runs a batch of one
+        def run(*args: P.args, **kwargs: P.kwargs) -> T:
+            task_id = current_task.request.id if current_task else None
+            return run_batch([BatchItem(id=task_id, args=args, kwargs=kwargs)])[0]
+
+        task_decorator = shared_task if app is None else app.task
+        task = task_decorator(
+            base=BatchedTask,
+            flush_every=flush_every,
+            flush_interval=flush_interval,
+            run_batch=staticmethod(run_batch),
+            **kwargs,
+        )(functools.wraps(main)(run))
+        return cast(BatchedTask[P], task)
+
+    return decorator
+
+
+def _execute_batch(task: BatchedTask, items: list[BatchItem]) -> bool:
+    try:
+        results = task.run_batch(items)
+        if len(results) != len(items):
+            raise ValueError(f"Batch returned {len(results)} results for {len(items)} items")
+    except Exception as exc:
+        logger.exception("Batch of %d %s tasks failed", len(items), task.name)
+        if not task.ignore_result:
+            for item in items:
+                task.backend.mark_as_failure(item.id, exc)
+        return False
+    if not task.ignore_result:
+        for item, result in zip(items, results):
+            task.backend.mark_as_done(item.id, result)
+    return True
+
+
+def _on_batch_done(task: BatchedTask, requests: list[Any], successful: bool) -> None:
+    for req in requests:
+        if task.acks_late:
+            req.acknowledge()
+        task_ready(req, successful=successful)
@@ -1,34 +1,51 @@
+import asyncio
+import functools
 import inspect
 import pickle
+import time
 from dataclasses import dataclass
-from celery import Task, Celery, shared_task
+from celery import Task, Celery, current_app, group, shared_task, signature
+from celery.exceptions import Retry
 from typing import (
     TYPE_CHECKING,
     Any,
     Awaitable,
     Callable,
     Generic,
+    Iterable,
     Literal,
+    Sequence,
     TypeVar,
     ParamSpec,
     Union,
     cast,
 )
+from .metrics import get_metrics
 from .typed import register_task
 
 if TYPE_CHECKING:
     from redis import Redis
+    from redis.asyncio import Redis as AsyncRedis
+    from unboil.redis import LocalCache
 
 __all__ = [
     "register_cached_task",
     "CachedTask",
     "CachedAsyncResult",
+    "CachedTaskError",
 ]
 
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
+_RECHECK_INTERVAL = 5.0
+_FAILURE_PREFIX = "error:"
+
+
+class CachedTaskError(RuntimeError):
+    pass
+
 
 @dataclass(kw_only=True)
 class ResolvedCachedAsyncResult(Generic[T]):
@@ -53,31 +70,226 @@ class CachedTask(Generic[P, T]):
         expire: int | None,
         key_func: Callable[..., str],
         deserialize: Callable[[bytes], T],
+        local_cache: "LocalCache | None" = None,
+        inflight_expire: int | None = None,
+        async_client: "AsyncRedis | None" = None,
+        refresh: "_RefreshAhead | None" = None,
     ):
         self._task = task
         self._redis = client
         self._expire = expire
         self._key_func = key_func
         self._deserialize = deserialize
+        self._local_cache = local_cache
+        self._inflight_expire = inflight_expire
+        self._async_redis = async_client
+        self._refresh = refresh
 
     def invalidate(self, *args: P.args, **kwargs: P.kwargs) -> None:
         key = self._key_func(*args, **kwargs)
         self._redis.delete(key)
+        if self._local_cache is not None:
+            self._local_cache.invalidate(key)
 
     def try_delay(self, *args: P.args, **kwargs: P.kwargs) -> CachedAsyncResult[T]:
         key = self._key_func(*args, **kwargs)
-        cached_result = self._redis.get(key)
+        if self._local_cache is not None:
+            local_value = self._local_cache.get(key)
+            if local_value is not None:
+                self._record(hit=True)
+                return ResolvedCachedAsyncResult(value=local_value)
+        cached_result = self._get(key, args, kwargs)
+        self._record(hit=cached_result is not None)
         if cached_result is None:
-            self._task.delay(*args, **kwargs)
+            self._enqueue(key, *args, **kwargs)
             return PendingCachedAsyncResult()
         else:
-            if isinstance(cached_result, bytes):
-                cached_result = cached_result
-            elif isinstance(cached_result, str):
-                cached_result = self._redis.get_encoder().encode(cached_result)
+            return ResolvedCachedAsyncResult(value=self._load(key, cached_result))
+
+    def try_delay_many(self, args_list: Sequence[tuple]) -> list[CachedAsyncResult[T]]:
+        keys = [self._key_func(*args) for args in args_list]
+        results: list[CachedAsyncResult[T] | None] = [None] * len(keys)
+        lookup = list(range(len(keys)))
+        if self._local_cache is not None:
+            lookup = []
+            for i, key in enumerate(keys):
+                local_value = self._local_cache.get(key)
+                if local_value is not None:
+                    self._record(hit=True)
+                    results[i] = ResolvedCachedAsyncResult(value=local_value)
+                else:
+                    lookup.append(i)
+        cached_results = self._mget([keys[i] for i in lookup], [args_list[i] for i in lookup]) if lookup else []
+        misses: dict[str, int] = {}
+        for i, cached_result in zip(lookup, cached_results):
+            self._record(hit=cached_result is not None)
+            if cached_result is None:
+                misses.setdefault(keys[i], i)
+                results[i] = PendingCachedAsyncResult()
             else:
-                raise ValueError("Unsupported type for cached value")
-            return ResolvedCachedAsyncResult(value=self._deserialize(cached_result))
+                results[i] = ResolvedCachedAsyncResult(value=self._load(keys[i], cached_result))
+        self._enqueue_many(self._task, {key: (args_list[i], {}) for key, i in misses.items()})
+        return cast(list[CachedAsyncResult[T]], results)
+
+    def wait_value(self, timeout: float | None, /, *args: P.args, **kwargs: P.kwargs) -> T:
+        key = self._key_func(*args, **kwargs)
+        if self._local_cache is not None:
+            local_value = self._local_cache.get(key)
+            if local_value is not None:
+                self._record(hit=True)
+                return local_value
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(_ready_channel(key))
+        try:
+            cached_result = self._get(key, args, kwargs)
+            self._record(hit=cached_result is not None)
+            if cached_result is None:
+                self._enqueue(key, *args, **kwargs)
+            while cached_result is None:
+                message = pubsub.get_message(timeout=_wait_interval(key, deadline))
+                cached_result = self._redis.get(key)
+                if cached_result is None:
+                    _raise_on_failure(key, message)
+            return self._load(key, cached_result)
+        finally:
+            pubsub.close()
+
+    async def await_value(self, timeout: float | None, /, *args: P.args, **kwargs: P.kwargs) -> T:
+        if self._async_redis is None:
+            return await asyncio.to_thread(self.wait_value, timeout, *args, **kwargs)
+        key = self._key_func(*args, **kwargs)
+        if self._local_cache is not None:
+            local_value = self._local_cache.get(key)
+            if local_value is not None:
+                self._record(hit=True)
+                return local_value
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pubsub = self._async_redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(_ready_channel(key))
+        try:
+            cached_result = await self._aget(key, args, kwargs)
+            self._record(hit=cached_result is not None)
+            if cached_result is None:
+                await asyncio.to_thread(self._enqueue, key, *args, **kwargs)
+            while cached_result is None:
+                message = await pubsub.get_message(timeout=_wait_interval(key, deadline))
+                cached_result = await self._async_redis.get(key)
+                if cached_result is None:
+                    _raise_on_failure(key, message)
+            return self._load(key, cached_result)
+        finally:
+            await pubsub.aclose()
+
+    def _enqueue(self, key: str, *args: Any, **kwargs: Any) -> None:
+        if self._inflight_expire is None:
+            self._task.delay(*args, **kwargs)
+            return
+        marker = _inflight_key(key)
+        if not self._redis.set(marker, "1", nx=True, ex=self._inflight_expire):
+            return
+        try:
+            self._task.delay(*args, **kwargs)
+        except BaseException:
+            self._redis.delete(marker)
+            raise
+
+    def refresh_hot_keys(self) -> int:
+        if self._refresh is None:
+            raise RuntimeError("refresh_ahead is not enabled for this cached task")
+        refresh = self._refresh
+        # each run consumes the access counts collected since the previous one
+        with self._redis.pipeline() as pipe:
+            pipe.zrangebyscore(refresh.hits_key, refresh.min_hits, "+inf")
+            pipe.zrange(refresh.hits_key, 0, -1)
+            pipe.delete(refresh.hits_key)
+            hot, tracked, _ = pipe.execute()
+        cold = set(tracked) - set(hot)
+        if cold:
+            self._redis.hdel(refresh.args_key, *cold)
+        if not hot:
+            return 0
+        with self._redis.pipeline(transaction=False) as pipe:
+            for key in hot:
+                pipe.pttl(key)
+            pipe.hmget(refresh.args_key, hot)
+            *ttls, packed_calls = pipe.execute()
+        due: dict[str, tuple[tuple, dict[str, Any]]] = {}
+        for key, ttl, packed_call in zip(hot, ttls, packed_calls):
+            # -2 means the entry already expired, -1 that it never will
+            if packed_call is not None and (ttl == -2 or 0 <= ttl <= refresh.ahead * 1000):
+                due[key.decode() if isinstance(key, bytes) else key] = pickle.loads(packed_call)
+        self._enqueue_many(refresh.task, due)
+        return len(due)
+
+    def _get(self, key: str, args: tuple, kwargs: dict[str, Any]) -> Any:
+        if self._refresh is None:
+            return self._redis.get(key)
+        with self._redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            self._refresh.track(pipe, key, args, kwargs)
+            return pipe.execute()[0]
+
+    async def _aget(self, key: str, args: tuple, kwargs: dict[str, Any]) -> Any:
+        assert self._async_redis is not None
+        if self._refresh is None:
+            return await self._async_redis.get(key)
+        async with self._async_redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            self._refresh.track(pipe, key, args, kwargs)
+            return (await pipe.execute())[0]
+
+    def _mget(self, keys: list[str], args_list: list[tuple]) -> list[Any]:
+        if self._refresh is None:
+            return self._redis.mget(keys)
+        with self._redis.pipeline(transaction=False) as pipe:
+            pipe.mget(keys)
+            for key, args in zip(keys, args_list):
+                self._refresh.track(pipe, key, args, {})
+            return pipe.execute()[0]
+
+    def _enqueue_many(self, task: Task, calls_by_key: dict[str, tuple[tuple, dict[str, Any]]]) -> None:
+        if not calls_by_key:
+            return
+        if self._inflight_expire is not None:
+            with self._redis.pipeline(transaction=False) as pipe:
+                for key in calls_by_key:
+                    pipe.set(_inflight_key(key), "1", nx=True, ex=self._inflight_expire)
+                acquired = pipe.execute()
+            calls_by_key = {
+                key: call
+                for (key, call), won in zip(calls_by_key.items(), acquired)
+                if won
+            }
+            if not calls_by_key:
+                return
+        try:
+            group(task.s(*args, **kwargs) for args, kwargs in calls_by_key.values()).apply_async()
+        except BaseException:
+            if self._inflight_expire is not None:
+                self._redis.delete(*(_inflight_key(key) for key in calls_by_key))
+            raise
+
+    def _record(self, hit: bool) -> None:
+        metrics = get_metrics()
+        if metrics is None:
+            return
+        if hit:
+            metrics.cache_hit(self._task.name)
+        else:
+            metrics.cache_miss(self._task.name)
+
+    def _load(self, key: str, cached_result: Any) -> T:
+        if isinstance(cached_result, bytes):
+            cached_result = cached_result
+        elif isinstance(cached_result, str):
+            cached_result = self._redis.get_encoder().encode(cached_result)
+        else:
+            raise ValueError("Unsupported type for cached value")
+        value = self._deserialize(cached_result)
+        if self._local_cache is not None:
+            self._local_cache.set(key, value, expire=self._expire)
+        return value
 
 
 def register_cached_task(
@@ -87,10 +299,17 @@ def register_cached_task(
     expire: int | None = None,
     serialize: Callable[[Any], bytes] | None = None,
     deserialize: Callable[[bytes], T] | None = None,
+    local_cache: "LocalCache | None" = None,
+    tags: Callable[P, Iterable[str]] | None = None,
+    inflight_expire: int | None = 60,
+    async_redis_client: "AsyncRedis | None" = None,
+    refresh_ahead: int | None = None,
+    refresh_min_hits: int = 2,
+    refresh_interval: float | None = None,
 ) -> Callable[[Callable[P, T | Awaitable[T]]], CachedTask[P, T]]:
     
     try:
-        from unboil.redis import cached, acached
+        from unboil.redis import cached, acached, default_codec
     except ImportError as e:
         raise ImportError(
             f"The '{register_cached_task.__name__}' feature requires the 'unboil.redis' module. "
@@ -98,10 +317,13 @@ def register_cached_task(
         ) from e
     
     if serialize is None:
-        serialize = pickle.dumps
+        serialize = default_codec.dumps
 
     if deserialize is None:
-        deserialize = pickle.loads
+        deserialize = default_codec.loads
+
+    if refresh_ahead is not None and expire is None:
+        raise ValueError("refresh_ahead requires an expire")
 
     def decorator(main: Callable[P, T | Awaitable[T]]) -> CachedTask[P, T]:
         if inspect.iscoroutinefunction(main):
@@ -111,6 +333,8 @@ def register_cached_task(
                 expire=expire,
                 serialize=serialize,
                 deserialize=deserialize,
+                local_cache=local_cache,
+                tags=tags,
             )(main)
         else:
             main = cast(Callable[P, T], main)
@@ -120,14 +344,129 @@ def register_cached_task(
                 expire=expire,
                 serialize=serialize,
                 deserialize=deserialize,
+                local_cache=local_cache,
+                tags=tags,
             )(main)
-        task = register_task(app=app)(cached_func)
-        return CachedTask(
+        notify = functools.partial(
+            _notify_computed,
+            client=redis_client,
+            key_func=key,
+            clear_inflight=inflight_expire is not None,
+        )
+        task = register_task(app=app)(notify(cached_func))
+        refresh = None
+        if refresh_ahead is not None:
+            # named explicitly so the shared_task proxy is not evaluated at import time
+            name = f"{main.__module__}.{main.__qualname__}"
+            refresh = _RefreshAhead(
+                task=register_task(app=app, name=f"{name}.refresh")(notify(getattr(cached_func, "refresh"))),
+                hits_key=f"unboil:refresh:{name}:hits",
+                args_key=f"unboil:refresh:{name}:args",
+                ahead=refresh_ahead,
+                min_hits=refresh_min_hits,
+            )
+
+            def refresh_hot_keys() -> int:
+                return cached_task.refresh_hot_keys()
+
+            register_task(app=app, name=f"{name}.refresh_ahead")(refresh_hot_keys)
+            (app or current_app).add_periodic_task(
+                refresh_interval or refresh_ahead / 2,
+                signature(f"{name}.refresh_ahead"),
+                name=f"{name}.refresh_ahead",
+            )
+        cached_task = CachedTask(
             task, 
             client=redis_client, 
             expire=expire, 
             key_func=key, 
-            deserialize=deserialize
+            deserialize=deserialize,
+            local_cache=local_cache,
+            inflight_expire=inflight_expire,
+            async_client=async_redis_client,
+            refresh=refresh,
         )
+        return cached_task
 
     return decorator
+
+
+@dataclass(kw_only=True)
+class _RefreshAhead:
+    task: Task
+    hits_key: str
+    args_key: str
+    ahead: int
+    min_hits: int
+
+    def track(self, pipe: Any, key: str, args: tuple, kwargs: dict[str, Any]) -> None:
+        pipe.zincrby(self.hits_key, 1, key)
+        pipe.hsetnx(self.args_key, key, pickle.dumps((tuple(args), kwargs)))
+
+
+def _notify_computed(
+    func: Callable[P, T | Awaitable[T]],
+    client: "Redis",
+    key_func: Callable[P, str],
+    clear_inflight: bool,
+) -> Callable[P, T | Awaitable[T]]:
+
+    def notify(key: str, error: BaseException | None = None) -> None:
+        if clear_inflight:
+            client.delete(_inflight_key(key))
+        if error is None:
+            client.publish(_ready_channel(key), "1")
+        elif not isinstance(error, Retry):
+            # without this, waiters would sit out their whole timeout
+            client.publish(_ready_channel(key), _FAILURE_PREFIX + repr(error))
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            try:
+                value = await func(*args, **kwargs)
+            except BaseException as e:
+                notify(key_func(*args, **kwargs), e)
+                raise
+            notify(key_func(*args, **kwargs))
+            return value
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> T | Awaitable[T]:
+        try:
+            value = func(*args, **kwargs)
+        except BaseException as e:
+            notify(key_func(*args, **kwargs), e)
+            raise
+        notify(key_func(*args, **kwargs))
+        return value
+    return wrapper
+
+
+def _wait_interval(key: str, deadline: float | None) -> float:
+    if deadline is None:
+        return _RECHECK_INTERVAL
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"Timed out waiting for cached value of {key}")
+    # re-check periodically in case a notification was missed
+    return min(remaining, _RECHECK_INTERVAL)
+
+
+def _raise_on_failure(key: str, message: dict[str, Any] | None) -> None:
+    if message is None:
+        return
+    data = message["data"]
+    if isinstance(data, bytes):
+        data = data.decode()
+    if isinstance(data, str) and data.startswith(_FAILURE_PREFIX):
+        raise CachedTaskError(f"Cached task for {key} failed: {data[len(_FAILURE_PREFIX):]}")
+
+
+def _inflight_key(key: str) -> str:
+    return f"{key}:inflight"
+
+
+def _ready_channel(key: str) -> str:
+    return f"{key}:ready"
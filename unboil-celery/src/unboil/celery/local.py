@@ -0,0 +1,137 @@
+import uuid
+from celery import Task, states
+from celery.exceptions import TimeoutError
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Literal, Optional
+
+
+__all__ = [
+    "LocalAsyncResult",
+    "LocalExecutor",
+    "enable_local_executor",
+    "disable_local_executor",
+    "get_local_executor",
+]
+
+
+class LocalAsyncResult:
+
+    def __init__(self, id: str, future: Future):
+        self.id = id
+        self._future = future
+
+    @property
+    def task_id(self) -> str:
+        return self.id
+
+    @property
+    def state(self) -> str:
+        if self._future.cancelled():
+            return states.REVOKED
+        if not self._future.done():
+            return states.STARTED if self._future.running() else states.PENDING
+        if self._future.exception() is not None:
+            return states.FAILURE
+        return states.SUCCESS
+
+    status = state
+
+    @property
+    def result(self) -> Any:
+        if not self._future.done() or self._future.cancelled():
+            return None
+        exception = self._future.exception()
+        return exception if exception is not None else self._future.result()
+
+    @property
+    def traceback(self) -> Any:
+        exception = self._future.exception() if self._future.done() and not self._future.cancelled() else None
+        return None if exception is None else exception.__traceback__
+
+    def get(self, timeout: Optional[float] = None, propagate: bool = True, **_: Any) -> Any:
+        try:
+            return self._future.result(timeout)
+        except FutureTimeoutError as e:
+            raise TimeoutError("The operation timed out.") from e
+        except Exception as e:
+            if propagate:
+                raise
+            return e
+
+    wait = get
+
+    def ready(self) -> bool:
+        return self._future.done()
+
+    def successful(self) -> bool:
+        return self.state == states.SUCCESS
+
+    def failed(self) -> bool:
+        return self.state == states.FAILURE
+
+    def revoke(self, **_: Any) -> None:
+        self._future.cancel()
+
+    def forget(self) -> None:
+        pass
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__}: {self.id}>"
+
+
+class LocalExecutor:
+
+    def __init__(
+        self,
+        kind: Literal["thread", "process"] = "thread",
+        max_workers: Optional[int] = None,
+    ):
+        self.kind = kind
+        if kind == "thread":
+            self._executor: Executor = ThreadPoolExecutor(max_workers, thread_name_prefix="unboil-celery-local")
+        elif kind == "process":
+            # tasks are pickled by name, so they must be importable in the child processes
+            self._executor = ProcessPoolExecutor(max_workers)
+        else:
+            raise ValueError(f"Unsupported executor kind: {kind}")
+
+    def submit(
+        self,
+        task: Task,
+        args: Optional[tuple] = None,
+        kwargs: Optional[dict[str, Any]] = None,
+        task_id: Optional[str] = None,
+        **options: Any,
+    ) -> LocalAsyncResult:
+        task_id = task_id or str(uuid.uuid4())
+        future = self._executor.submit(_apply, task, tuple(args or ()), dict(kwargs or {}), task_id, options.get("headers"))
+        return LocalAsyncResult(task_id, future)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+_executor: Optional[LocalExecutor] = None
+
+
+def enable_local_executor(executor: Optional[LocalExecutor] = None) -> LocalExecutor:
+    global _executor
+    _executor = executor or LocalExecutor()
+    return _executor
+
+
+def disable_local_executor(wait: bool = True) -> None:
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def get_local_executor() -> Optional[LocalExecutor]:
+    return _executor
+
+
+def _apply(task: Task, args: tuple, kwargs: dict[str, Any], task_id: str, headers: Optional[dict[str, Any]]) -> Any:
+    # Task.apply runs the full trace (signals, retries) in the calling thread
+    return task.apply(args, kwargs, task_id=task_id, headers=headers).get()
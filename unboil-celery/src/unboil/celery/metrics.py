@@ -0,0 +1,165 @@
+import bisect
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Callable, Literal, Optional
+
+
+__all__ = [
+    "Histogram",
+    "TaskMetrics",
+    "TaskStats",
+    "TaskEvent",
+    "enable_metrics",
+    "disable_metrics",
+    "get_metrics",
+]
+
+TaskEventKind = Literal[
+    "queue_wait",
+    "run",
+    "failure",
+    "cache_hit",
+    "cache_miss",
+]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+@dataclass(kw_only=True)
+class Histogram:
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    # one counter per bucket upper bound plus a final overflow bucket
+    counts: list[int] = field(default_factory=list)
+    count: int = 0
+    total: float = 0.0
+
+    def __post_init__(self):
+        if not self.counts:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    @property
+    def mean(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def copy(self) -> "Histogram":
+        return replace(self, counts=list(self.counts))
+
+
+@dataclass(kw_only=True)
+class TaskStats:
+    queue_wait: Histogram = field(default_factory=Histogram)
+    run_time: Histogram = field(default_factory=Histogram)
+    failures: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        if lookups == 0:
+            return 0.0
+        return self.cache_hits / lookups
+
+
+@dataclass(kw_only=True)
+class TaskEvent:
+    kind: TaskEventKind
+    task: str
+    duration: float = 0.0
+
+
+class TaskMetrics:
+
+    def __init__(
+        self,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        callback: Optional[Callable[[TaskEvent], None]] = None,
+    ):
+        self._buckets = buckets
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._stats: dict[str, TaskStats] = {}
+
+    def stats(self) -> dict[str, TaskStats]:
+        with self._lock:
+            return {
+                task: replace(stats, queue_wait=stats.queue_wait.copy(), run_time=stats.run_time.copy())
+                for task, stats in self._stats.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def queue_wait(self, task: str, duration: float) -> None:
+        with self._lock:
+            self._get(task).queue_wait.observe(duration)
+        self._emit("queue_wait", task, duration)
+
+    def run(self, task: str, duration: float, failed: bool = False) -> None:
+        with self._lock:
+            stats = self._get(task)
+            stats.run_time.observe(duration)
+            if failed:
+                stats.failures += 1
+        self._emit("failure" if failed else "run", task, duration)
+
+    def cache_hit(self, task: str) -> None:
+        with self._lock:
+            self._get(task).cache_hits += 1
+        self._emit("cache_hit", task)
+
+    def cache_miss(self, task: str) -> None:
+        with self._lock:
+            self._get(task).cache_misses += 1
+        self._emit("cache_miss", task)
+
+    def _get(self, task: str) -> TaskStats:
+        stats = self._stats.get(task)
+        if stats is None:
+            stats = self._stats[task] = TaskStats(
+                queue_wait=Histogram(buckets=self._buckets),
+                run_time=Histogram(buckets=self._buckets),
+            )
+        return stats
+
+    def _emit(self, kind: TaskEventKind, task: str, duration: float = 0.0) -> None:
+        if self._callback is not None:
+            self._callback(TaskEvent(kind=kind, task=task, duration=duration))
+
+
+_metrics: Optional[TaskMetrics] = None
+
+
+def enable_metrics(metrics: Optional[TaskMetrics] = None) -> TaskMetrics:
+    global _metrics
+    _metrics = metrics or TaskMetrics()
+    return _metrics
+
+
+def disable_metrics() -> None:
+    global _metrics
+    _metrics = None
+
+
+def get_metrics() -> Optional[TaskMetrics]:
+    return _metrics
@@ -1,11 +1,27 @@
 import asyncio
 import functools
 import inspect
-from celery import Celery, Task, shared_task
+import itertools
+import threading
+import time
+from collections import deque
+from celery import Celery, Task, group, shared_task
 from celery.result import AsyncResult
+from celery.signals import (
+    task_postrun,
+    task_prerun,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
+from datetime import datetime
 from typing import (
     TYPE_CHECKING,
+    Coroutine,
     Generic,
+    Iterable,
+    Iterator,
+    Literal,
     ParamSpec,
     Callable,
     Awaitable,
@@ -13,16 +29,22 @@ from typing import (
     TypeVar,
     cast,
 )
+from .local import get_local_executor
+from .metrics import get_metrics
 
 __all__ = [
     "TypedTask",
+    "WorkerEventLoop",
     "register_task",
+    "worker_event_loop",
 ]
 
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
+ENQUEUED_AT_HEADER = "unboil_enqueued_at"
+
 
 class TypedTask(Task, Generic[P]):
 
@@ -31,9 +53,131 @@ class TypedTask(Task, Generic[P]):
         def __call__(self, *args: P.args, **kwargs: P.kwargs): ...
         def delay(self, *args: P.args, **kwargs: P.kwargs) -> AsyncResult: ...
 
+    def apply_async(self, args=None, kwargs=None, **options) -> AsyncResult:
+        # stamped on every send so workers with metrics enabled can measure queue wait
+        headers = dict(options.get("headers") or {})
+        headers[ENQUEUED_AT_HEADER] = _due_at(options)
+        options["headers"] = headers
+        executor = get_local_executor()
+        if executor is not None:
+            return cast(AsyncResult, executor.submit(self, args, kwargs, **options))
+        return super().apply_async(args, kwargs, **options)
+
+    def map_chunks(
+        self,
+        iterable: Iterable[tuple],
+        chunk_size: int = 100,
+        max_in_flight: int = 8,
+        ordered: bool = True,
+        interval: float = 0.1,
+    ) -> Iterator[Any]:
+        chunks = _chunked(iterable, chunk_size)
+        pending: deque[AsyncResult] = deque()
+
+        def dispatch(count: int) -> None:
+            signatures = [self.starmap(chunk) for chunk in itertools.islice(chunks, count)]
+            executor = get_local_executor()
+            if executor is not None:
+                pending.extend(
+                    cast(AsyncResult, executor.submit(signature.type, signature.args, signature.kwargs))
+                    for signature in signatures
+                )
+            elif signatures:
+                pending.extend(group(signatures).apply_async().results)
+
+        dispatch(max_in_flight)
+        while pending:
+            if ordered:
+                result = pending.popleft()
+            else:
+                result = _first_ready(pending, interval)
+                pending.remove(result)
+            values = result.get(interval=interval)
+            # top up before yielding so the workers stay busy while the caller consumes
+            dispatch(max_in_flight - len(pending))
+            yield from values
+
+
+class WorkerEventLoop:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            # a forked child inherits the loop but not the thread running it
+            if self._loop is None or self._thread is None or not self._thread.is_alive():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="unboil-celery-event-loop", daemon=True)
+                thread.start()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        # one loop on its own thread serves every pool thread or greenlet,
+        # so thread-local loops never pile up under threads/gevent/eventlet
+        return asyncio.run_coroutine_threadsafe(coro, self.start()).result()
+
+    def close(self) -> None:
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        if thread is not None and thread.is_alive():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+        if not loop.is_closed():
+            _close_loop(loop)
+
+
+worker_event_loop = WorkerEventLoop()
+
+
+@worker_process_init.connect(weak=False)
+def _start_worker_event_loop(**_: Any) -> None:
+    worker_event_loop.start()
+
+
+@worker_process_shutdown.connect(weak=False)
+@worker_shutdown.connect(weak=False)
+def _close_worker_event_loop(**_: Any) -> None:
+    worker_event_loop.close()
+
+
+_started_at: dict[str, float] = {}
+
+
+@task_prerun.connect(weak=False)
+def _record_queue_wait(task_id: str, task: Task, **_: Any) -> None:
+    metrics = get_metrics()
+    if metrics is None or not isinstance(task, TypedTask):
+        return
+    enqueued_at = getattr(task.request, ENQUEUED_AT_HEADER, None)
+    if enqueued_at is None:
+        # Task.apply (eager mode, the local executor) keeps custom headers nested
+        enqueued_at = (task.request.headers or {}).get(ENQUEUED_AT_HEADER)
+    if enqueued_at is not None:
+        metrics.queue_wait(task.name, max(time.time() - enqueued_at, 0.0))
+    _started_at[task_id] = time.perf_counter()
+
+
+@task_postrun.connect(weak=False)
+def _record_run_time(task_id: str, task: Task, state: str | None = None, **_: Any) -> None:
+    started_at = _started_at.pop(task_id, None)
+    metrics = get_metrics()
+    if metrics is None or started_at is None:
+        return
+    metrics.run(task.name, time.perf_counter() - started_at, failed=state == "FAILURE")
+
 
 def register_task(
-    app: Celery | None = None, **kwargs
+    app: Celery | None = None,
+    event_loop: Literal["worker", "task"] = "worker",
+    base: type[TypedTask] = TypedTask,
+    **kwargs,
 ) -> Callable[[Callable[P, T | Awaitable[T]]], TypedTask[P]]:
 
     def decorator(main: Callable[P, T | Awaitable[T]]) -> TypedTask[P]:
@@ -41,9 +185,50 @@ def register_task(
             wrapped = main
         else:
             def async_caller(*args: P.args, **kwargs: P.kwargs) -> Any:
-                return asyncio.run(main(*args, **kwargs))
+                if event_loop == "task":
+                    return asyncio.run(main(*args, **kwargs))
+                return worker_event_loop.run(main(*args, **kwargs))
             wrapped = functools.wraps(main)(async_caller)
         task_decorator = shared_task if app is None else app.task
-        return cast(TypedTask[P], task_decorator(**kwargs)(wrapped))
+        return cast(TypedTask[P], task_decorator(base=base, **kwargs)(wrapped))
 
     return decorator
+
+
+def _close_loop(loop: asyncio.AbstractEventLoop) -> None:
+    try:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        loop.close()
+
+
+def _due_at(options: dict[str, Any]) -> float:
+    # delayed sends start waiting in the queue once their eta is reached
+    now = time.time()
+    eta = options.get("eta")
+    if isinstance(eta, datetime) and eta.tzinfo is not None:
+        return max(eta.timestamp(), now)
+    countdown = options.get("countdown")
+    if countdown:
+        return now + countdown
+    return now
+
+
+def _chunked(iterable: Iterable[tuple], size: int) -> Iterator[list[tuple]]:
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def _first_ready(results: Iterable[AsyncResult], interval: float) -> AsyncResult:
+    while True:
+        for result in results:
+            if result.ready():
+                return result
+        time.sleep(interval)
@@ -0,0 +1,70 @@
+"""
+Measures event-loop stall while many coroutines share one loop and call
+`acached`, once with the blocking `redis.Redis` client and once with
+`redis.asyncio.Redis`.
+
+    REDIS_URL=redis://localhost:6379/0 python benchmarks/acached_event_loop.py
+"""
+import asyncio
+import os
+import time
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from unboil.redis import acached
+
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+COROUTINES = int(os.environ.get("COROUTINES", "200"))
+CALLS = int(os.environ.get("CALLS", "50"))
+TICK = 0.001
+
+
+async def heartbeat(stop: asyncio.Event, lags: list[float]) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def run(client: Redis | AsyncRedis, label: str) -> None:
+
+    @acached(client, key=lambda i: f"bench:acached:{i % 100}", expire=60)
+    async def compute(i: int) -> int:
+        return i
+
+    async def worker(n: int) -> None:
+        for i in range(CALLS):
+            await compute(n * CALLS + i)
+
+    stop = asyncio.Event()
+    lags: list[float] = []
+    beat = asyncio.create_task(heartbeat(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(COROUTINES)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(
+        f"{label:>12}: {COROUTINES * CALLS / elapsed:10.0f} calls/s  "
+        f"heartbeats={len(lags):6d}  "
+        f"p99 lag={p99 * 1000:8.2f}ms  "
+        f"max lag={(lags[-1] if lags else 0.0) * 1000:8.2f}ms"
+    )
+
+
+async def main() -> None:
+    sync_client = Redis.from_url(REDIS_URL)
+    async_client = AsyncRedis.from_url(REDIS_URL, max_connections=COROUTINES)
+    try:
+        await run(sync_client, "redis.Redis")
+        await run(async_client, "asyncio.Redis")
+    finally:
+        sync_client.close()
+        await async_client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
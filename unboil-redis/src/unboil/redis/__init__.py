@@ -1,127 +1,1104 @@
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
 import functools
-import pickle
+import logging
+import math
+import random
+import struct
+import threading
+import time
+from dataclasses import dataclass
 from redis import Redis
-from typing import Any, Callable, Optional, TypeVar, ParamSpec, Awaitable
+from redis.asyncio import Redis as AsyncRedis
+from typing import Any, Callable, Generic, Iterable, Optional, Sequence, TypeVar, ParamSpec, Awaitable
+from .codecs import Codec, CodecError, default_codec
+from .local import LocalCache
+from .metrics import CacheMetrics, CacheStats, CacheEvent, enable_metrics, disable_metrics, get_metrics
+from .sharding import ShardedRedis, route
 
 
 __all__ = [
+    "MISSING",
     "cached",
     "acached",
+    "cached_many",
+    "acached_many",
     "redis_get",
     "redis_set",
+    "aredis_get",
+    "aredis_set",
+    "redis_get_many",
+    "redis_set_many",
+    "aredis_get_many",
+    "aredis_set_many",
+    "acquire_lock",
+    "aacquire_lock",
+    "redis_delete",
+    "aredis_delete",
+    "invalidate_tags",
+    "ainvalidate_tags",
+    "LocalCache",
+    "Codec",
+    "CodecError",
+    "default_codec",
+    "CacheMetrics",
+    "CacheStats",
+    "CacheEvent",
+    "enable_metrics",
+    "disable_metrics",
+    "get_metrics",
+    "ShardedRedis",
 ]
 
 T = TypeVar("T")
+D = TypeVar("D")
 P = ParamSpec("P")
+TArgs = TypeVar("TArgs", bound=tuple)
+
+Client = Redis | ShardedRedis[Redis]
+AnyClient = Redis | AsyncRedis | ShardedRedis[Redis] | ShardedRedis[AsyncRedis]
+
+_LOCK_POLL_INTERVAL = 0.05
+_TAG_PREFIX = "unboil:tag:"
+
+_INVALIDATE_TAGS_SCRIPT = """
+local deleted = 0
+for _, tag in ipairs(KEYS) do
+    local members = redis.call('SMEMBERS', tag)
+    for i = 1, #members, 5000 do
+        local chunk = {unpack(members, i, math.min(i + 4999, #members))}
+        deleted = deleted + redis.call('DEL', unpack(chunk))
+        if ARGV[1] ~= '' then
+            for _, member in ipairs(chunk) do
+                redis.call('PUBLISH', ARGV[1], member)
+            end
+        end
+    end
+    redis.call('DEL', tag)
+end
+return deleted
+"""
+
+# tag sets must outlive their longest-lived member: a persistent member
+# makes the set persistent, otherwise the TTL only ever grows
+_ADD_TAGS_SCRIPT = """
+for _, tag in ipairs(KEYS) do
+    local ttl = redis.call('TTL', tag)
+    redis.call('SADD', tag, ARGV[1])
+    if ARGV[2] == '' then
+        redis.call('PERSIST', tag)
+    elseif ttl == -2 or (ttl >= 0 and ttl < tonumber(ARGV[2])) then
+        redis.call('EXPIRE', tag, ARGV[2])
+    end
+end
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class _Missing:
+
+    def __repr__(self) -> str:
+        return "MISSING"
+
+    def __bool__(self) -> bool:
+        return False
+
+
+MISSING = _Missing()
 
 
 def cached(
-    client: Redis,
+    client: Client,
     key: str | Callable[P, str],
     expire: Optional[int] = None,
     serialize: Optional[Callable[[Any], bytes]] = None,
     deserialize: Optional[Callable[[bytes], T]] = None,
+    single_flight: bool = False,
+    lock_expire: int = 60,
+    lock_wait: float = 10.0,
+    local_cache: Optional[LocalCache] = None,
+    early_refresh: bool = False,
+    beta: float = 1.0,
+    stale_ttl: Optional[int] = None,
+    tags: Optional[Callable[P, Iterable[str]]] = None,
+    negative_expire: Optional[int] = None,
 ) -> Callable[[Callable[P, T]], Callable[P, T]]:
     def decorator(func: Callable[P, T]) -> Callable[P, T]:
-        @functools.wraps(func)
-        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-            if isinstance(key, str):
-                computed_key = key
-            else:
-                computed_key = key(*args, **kwargs)
-            cached_value = redis_get(
-                client, 
-                key=computed_key, 
-                deserialize=deserialize
-            )
-            if cached_value is not None:
-                return cached_value
+        flights = _SingleFlight[T]()
+        refreshes = _BackgroundRefresh()
+        entries = None
+        if early_refresh or stale_ttl is not None:
+            entries = _EntryCodec[T](expire, stale_ttl, serialize, deserialize)
+        read_deserialize = deserialize if entries is None else entries.deserialize_value
+
+        def store(computed_key: str, /, *args: P.args, **kwargs: P.kwargs) -> T:
+            started = time.monotonic()
             computed_value = func(*args, **kwargs)
+            ttl = _ttl_for(computed_value, expire, negative_expire)
             redis_set(
-                client, 
-                key=computed_key, 
-                value=computed_value, 
-                expire=expire, 
-                serialize=serialize
+                client,
+                key=computed_key,
+                value=computed_value,
+                expire=ttl if entries is None else entries.expire(ttl),
+                serialize=serialize if entries is None else entries.serializer(time.monotonic() - started, ttl)
             )
+            if tags is not None:
+                _add_tags(client, key=computed_key, tags=tags(*args, **kwargs), expire=ttl)
             return computed_value
+
+        def load(computed_key: str, /, *args: P.args, **kwargs: P.kwargs) -> T:
+
+            def compute() -> T:
+                return store(computed_key, *args, **kwargs)
+
+            def refresh() -> T | _Missing:
+                with acquire_lock(client, _refresh_lock_key(computed_key), expire=lock_expire) as acquired:
+                    return compute() if acquired else MISSING
+
+            if entries is None:
+                cached_value = redis_get(
+                    client,
+                    key=computed_key,
+                    deserialize=deserialize,
+                    default=MISSING,
+                )
+                if cached_value is not MISSING:
+                    return cached_value
+            else:
+                entry = redis_get(client, key=computed_key, deserialize=entries.deserialize_entry)
+                if entry is not None:
+                    if not entry.should_refresh(beta if early_refresh else 0.0):
+                        return entry.value
+                    if stale_ttl is not None:
+                        refreshes.start(computed_key, refresh)
+                        return entry.value
+                    if not entry.expired:
+                        refreshed_value = refresh()
+                        return entry.value if refreshed_value is MISSING else refreshed_value
+
+            if not single_flight:
+                return compute()
+
+            def compute_once() -> T:
+                with acquire_lock(client, _lock_key(computed_key), expire=lock_expire) as acquired:
+                    if not acquired:
+                        cached_value = _wait_for_value(
+                            client,
+                            key=computed_key,
+                            timeout=lock_wait,
+                            deserialize=read_deserialize,
+                        )
+                        if cached_value is not MISSING:
+                            return cached_value
+                    else:
+                        # the lookup was already counted before taking the lock
+                        cached_value = _redis_get(client, computed_key, read_deserialize, MISSING, lookup=False)
+                        if cached_value is not MISSING:
+                            return cached_value
+                    return compute()
+
+            return flights.do(computed_key, compute_once)
+
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            computed_key = _compute_key(key, *args, **kwargs)
+            if local_cache is None:
+                return load(computed_key, *args, **kwargs)
+            value = local_cache.get(computed_key, MISSING)
+            if value is not MISSING:
+                metrics = get_metrics()
+                if metrics is not None:
+                    metrics.local_hit(computed_key)
+            else:
+                value = load(computed_key, *args, **kwargs)
+                local_cache.set(computed_key, value, expire=_ttl_for(value, expire, negative_expire))
+            return value
+
+        # recomputes and overwrites the entry without reading it first
+        def refresh(*args: P.args, **kwargs: P.kwargs) -> T:
+            computed_key = _compute_key(key, *args, **kwargs)
+            value = store(computed_key, *args, **kwargs)
+            if local_cache is not None:
+                local_cache.invalidate(computed_key)
+            return value
+
+        wrapper.refresh = refresh  # type: ignore[attr-defined]
         return wrapper
     return decorator
 
 
 def acached(
-    client: Redis,
+    client: AnyClient,
     key: str | Callable[P, str],
     expire: Optional[int] = None,
     serialize: Optional[Callable[[Any], bytes]] = None,
     deserialize: Optional[Callable[[bytes], T]] = None,
+    single_flight: bool = False,
+    lock_expire: int = 60,
+    lock_wait: float = 10.0,
+    local_cache: Optional[LocalCache] = None,
+    early_refresh: bool = False,
+    beta: float = 1.0,
+    stale_ttl: Optional[int] = None,
+    tags: Optional[Callable[P, Iterable[str]]] = None,
+    negative_expire: Optional[int] = None,
 ) -> Callable[[Callable[P, Awaitable[T]]], Callable[P, Awaitable[T]]]:
     def decorator(func: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+        flights = _AsyncSingleFlight[T]()
+        refreshes = _AsyncBackgroundRefresh()
+        entries = None
+        if early_refresh or stale_ttl is not None:
+            entries = _EntryCodec[T](expire, stale_ttl, serialize, deserialize)
+        read_deserialize = deserialize if entries is None else entries.deserialize_value
+
+        async def store(computed_key: str, /, *args: P.args, **kwargs: P.kwargs) -> T:
+            started = time.monotonic()
+            computed_value = await func(*args, **kwargs)
+            ttl = _ttl_for(computed_value, expire, negative_expire)
+            await aredis_set(
+                client,
+                key=computed_key,
+                value=computed_value,
+                expire=ttl if entries is None else entries.expire(ttl),
+                serialize=serialize if entries is None else entries.serializer(time.monotonic() - started, ttl)
+            )
+            if tags is not None:
+                await _aadd_tags(client, key=computed_key, tags=tags(*args, **kwargs), expire=ttl)
+            return computed_value
+
+        async def load(computed_key: str, /, *args: P.args, **kwargs: P.kwargs) -> T:
+
+            async def compute() -> T:
+                return await store(computed_key, *args, **kwargs)
+
+            async def refresh() -> T | _Missing:
+                async with aacquire_lock(client, _refresh_lock_key(computed_key), expire=lock_expire) as acquired:
+                    return await compute() if acquired else MISSING
+
+            if entries is None:
+                cached_value = await aredis_get(
+                    client,
+                    key=computed_key,
+                    deserialize=deserialize,
+                    default=MISSING,
+                )
+                if cached_value is not MISSING:
+                    return cached_value
+            else:
+                entry = await aredis_get(client, key=computed_key, deserialize=entries.deserialize_entry)
+                if entry is not None:
+                    if not entry.should_refresh(beta if early_refresh else 0.0):
+                        return entry.value
+                    if stale_ttl is not None:
+                        refreshes.start(computed_key, refresh)
+                        return entry.value
+                    if not entry.expired:
+                        refreshed_value = await refresh()
+                        return entry.value if refreshed_value is MISSING else refreshed_value
+
+            if not single_flight:
+                return await compute()
+
+            async def compute_once() -> T:
+                async with aacquire_lock(client, _lock_key(computed_key), expire=lock_expire) as acquired:
+                    if not acquired:
+                        cached_value = await _await_for_value(
+                            client,
+                            key=computed_key,
+                            timeout=lock_wait,
+                            deserialize=read_deserialize,
+                        )
+                        if cached_value is not MISSING:
+                            return cached_value
+                    else:
+                        # the lookup was already counted before taking the lock
+                        cached_value = await _aredis_get(client, computed_key, read_deserialize, MISSING, lookup=False)
+                        if cached_value is not MISSING:
+                            return cached_value
+                    return await compute()
+
+            return await flights.do(computed_key, compute_once)
+
         @functools.wraps(func)
         async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-            if isinstance(key, str):
-                computed_key = key
+            computed_key = _compute_key(key, *args, **kwargs)
+            if local_cache is None:
+                return await load(computed_key, *args, **kwargs)
+            value = local_cache.get(computed_key, MISSING)
+            if value is not MISSING:
+                metrics = get_metrics()
+                if metrics is not None:
+                    metrics.local_hit(computed_key)
             else:
-                computed_key = key(*args, **kwargs)
-            cached_value = redis_get(
-                client, 
-                key=computed_key, 
-                deserialize=deserialize
+                value = await load(computed_key, *args, **kwargs)
+                local_cache.set(computed_key, value, expire=_ttl_for(value, expire, negative_expire))
+            return value
+
+        # recomputes and overwrites the entry without reading it first
+        async def refresh(*args: P.args, **kwargs: P.kwargs) -> T:
+            computed_key = _compute_key(key, *args, **kwargs)
+            value = await store(computed_key, *args, **kwargs)
+            if local_cache is not None:
+                local_cache.invalidate(computed_key)
+            return value
+
+        wrapper.refresh = refresh  # type: ignore[attr-defined]
+        return wrapper
+    return decorator
+
+
+def cached_many(
+    client: Client,
+    key: Callable[..., str],
+    expire: Optional[int] = None,
+    serialize: Optional[Callable[[Any], bytes]] = None,
+    deserialize: Optional[Callable[[bytes], T]] = None,
+    negative_expire: Optional[int] = None,
+) -> Callable[[Callable[[list[TArgs]], Sequence[T]]], Callable[[Sequence[TArgs]], list[T]]]:
+    def decorator(func: Callable[[list[TArgs]], Sequence[T]]) -> Callable[[Sequence[TArgs]], list[T]]:
+        @functools.wraps(func)
+        def wrapper(args_list: Sequence[TArgs]) -> list[T]:
+            keys = [key(*args) for args in args_list]
+            values = redis_get_many(client, keys=keys, deserialize=deserialize, default=MISSING)
+            misses = _find_misses(keys, values)
+            if not misses:
+                return values
+            computed_values = func([args_list[i] for i in misses.values()])
+            computed = _check_computed(misses, computed_values)
+            positive, negative = _split_negative(computed, negative_expire)
+            redis_set_many(
+                client,
+                values=positive,
+                expire=expire,
+                serialize=serialize,
             )
-            if cached_value is not None:
-                return cached_value
-            computed_value = await func(*args, **kwargs)
-            redis_set(
-                client, 
-                key=computed_key, 
-                value=computed_value, 
-                expire=expire, 
-                serialize=serialize
+            if negative:
+                redis_set_many(
+                    client,
+                    values=negative,
+                    expire=negative_expire,
+                    serialize=serialize,
+                )
+            return _merge_computed(keys, values, computed)
+        return wrapper
+    return decorator
+
+
+def acached_many(
+    client: AnyClient,
+    key: Callable[..., str],
+    expire: Optional[int] = None,
+    serialize: Optional[Callable[[Any], bytes]] = None,
+    deserialize: Optional[Callable[[bytes], T]] = None,
+    negative_expire: Optional[int] = None,
+) -> Callable[[Callable[[list[TArgs]], Awaitable[Sequence[T]]]], Callable[[Sequence[TArgs]], Awaitable[list[T]]]]:
+    def decorator(func: Callable[[list[TArgs]], Awaitable[Sequence[T]]]) -> Callable[[Sequence[TArgs]], Awaitable[list[T]]]:
+        @functools.wraps(func)
+        async def wrapper(args_list: Sequence[TArgs]) -> list[T]:
+            keys = [key(*args) for args in args_list]
+            values = await aredis_get_many(client, keys=keys, deserialize=deserialize, default=MISSING)
+            misses = _find_misses(keys, values)
+            if not misses:
+                return values
+            computed_values = await func([args_list[i] for i in misses.values()])
+            computed = _check_computed(misses, computed_values)
+            positive, negative = _split_negative(computed, negative_expire)
+            await aredis_set_many(
+                client,
+                values=positive,
+                expire=expire,
+                serialize=serialize,
             )
-            return computed_value
+            if negative:
+                await aredis_set_many(
+                    client,
+                    values=negative,
+                    expire=negative_expire,
+                    serialize=serialize,
+                )
+            return _merge_computed(keys, values, computed)
         return wrapper
     return decorator
 
 
 def redis_set(
-    client: Redis, 
-    key: str, value: Any, 
+    client: Client,
+    key: str, value: Any,
     expire: Optional[int],
     serialize: Optional[Callable[[Any], bytes]] = None
 ) -> None:
-    if serialize is None:
-        serialize = pickle.dumps
-    client.set(key, serialize(value), ex=expire)
+    client = route(client, key)
+    metrics = get_metrics()
+    data = _encode(key, value, serialize, metrics)
+    started = time.perf_counter()
+    client.set(key, data, ex=expire)
+    if metrics is not None:
+        metrics.redis_call(key, time.perf_counter() - started)
 
 
 def redis_get(
-    client: Redis, 
-    key: str, 
+    client: Client,
+    key: str,
     deserialize: Optional[Callable[[bytes], T]] = None,
-) -> Optional[T]:
-    if deserialize is None:
-        deserialize = pickle.loads
+    default: D = None,
+) -> T | D:
+    return _redis_get(client, key, deserialize, default, lookup=True)
+
+
+def _redis_get(
+    client: Client,
+    key: str,
+    deserialize: Optional[Callable[[bytes], T]],
+    default: D,
+    lookup: bool,
+) -> T | D:
+    client = route(client, key)
+    metrics = get_metrics()
+    started = time.perf_counter()
     cached_value = client.get(key)
-    if cached_value is not None:
-        if isinstance(cached_value, bytes):
-            value = cached_value
-        elif isinstance(cached_value, str):
-            value = client.get_encoder().encode(cached_value)
+    if metrics is not None:
+        metrics.redis_call(key, time.perf_counter() - started)
+    return _decode(client, key, cached_value, deserialize, default, metrics, lookup)
+
+
+async def aredis_set(
+    client: AnyClient,
+    key: str, value: Any,
+    expire: Optional[int],
+    serialize: Optional[Callable[[Any], bytes]] = None
+) -> None:
+    client = route(client, key)
+    metrics = get_metrics()
+    data = _encode(key, value, serialize, metrics)
+    started = time.perf_counter()
+    if isinstance(client, AsyncRedis):
+        await client.set(key, data, ex=expire)
+    else:
+        client.set(key, data, ex=expire)
+    if metrics is not None:
+        metrics.redis_call(key, time.perf_counter() - started)
+
+
+async def aredis_get(
+    client: AnyClient,
+    key: str,
+    deserialize: Optional[Callable[[bytes], T]] = None,
+    default: D = None,
+) -> T | D:
+    return await _aredis_get(client, key, deserialize, default, lookup=True)
+
+
+async def _aredis_get(
+    client: AnyClient,
+    key: str,
+    deserialize: Optional[Callable[[bytes], T]],
+    default: D,
+    lookup: bool,
+) -> T | D:
+    client = route(client, key)
+    metrics = get_metrics()
+    started = time.perf_counter()
+    if isinstance(client, AsyncRedis):
+        cached_value = await client.get(key)
+    else:
+        cached_value = client.get(key)
+    if metrics is not None:
+        metrics.redis_call(key, time.perf_counter() - started)
+    return _decode(client, key, cached_value, deserialize, default, metrics, lookup)
+
+
+def redis_set_many(
+    client: Client,
+    values: dict[str, Any],
+    expire: Optional[int],
+    serialize: Optional[Callable[[Any], bytes]] = None
+) -> None:
+    if not values:
+        return
+    if isinstance(client, ShardedRedis):
+        groups = _partition_values(client, values)
+        client.run_concurrently([
+            functools.partial(redis_set_many, client.nodes[name], group, expire, serialize)
+            for name, group in groups.items()
+        ])
+        return
+    metrics = get_metrics()
+    with client.pipeline(transaction=False) as pipe:
+        for key, value in values.items():
+            pipe.set(key, _encode(key, value, serialize, metrics), ex=expire)
+        started = time.perf_counter()
+        pipe.execute()
+    if metrics is not None:
+        # a pipeline is one round trip, attributed to the first key's prefix
+        metrics.redis_call(next(iter(values)), time.perf_counter() - started)
+
+
+def redis_get_many(
+    client: Client,
+    keys: Sequence[str],
+    deserialize: Optional[Callable[[bytes], T]] = None,
+    default: D = None,
+) -> list[T | D]:
+    if not keys:
+        return []
+    if isinstance(client, ShardedRedis):
+        groups = client.partition(keys)
+        results = client.run_concurrently([
+            functools.partial(redis_get_many, client.nodes[name], [keys[i] for i in indexes], deserialize, default)
+            for name, indexes in groups.items()
+        ])
+        return _unpartition(len(keys), list(groups.values()), results)
+    metrics = get_metrics()
+    started = time.perf_counter()
+    cached_values = client.mget(keys)
+    if metrics is not None:
+        metrics.redis_call(keys[0], time.perf_counter() - started)
+    return [
+        _decode(client, key, cached_value, deserialize, default, metrics)
+        for key, cached_value in zip(keys, cached_values)
+    ]
+
+
+async def aredis_set_many(
+    client: AnyClient,
+    values: dict[str, Any],
+    expire: Optional[int],
+    serialize: Optional[Callable[[Any], bytes]] = None
+) -> None:
+    if not values:
+        return
+    if isinstance(client, ShardedRedis):
+        groups = _partition_values(client, values)
+        await asyncio.gather(*(
+            aredis_set_many(client.nodes[name], group, expire, serialize)
+            for name, group in groups.items()
+        ))
+        return
+    if not isinstance(client, AsyncRedis):
+        redis_set_many(client, values=values, expire=expire, serialize=serialize)
+        return
+    metrics = get_metrics()
+    async with client.pipeline(transaction=False) as pipe:
+        for key, value in values.items():
+            pipe.set(key, _encode(key, value, serialize, metrics), ex=expire)
+        started = time.perf_counter()
+        await pipe.execute()
+    if metrics is not None:
+        metrics.redis_call(next(iter(values)), time.perf_counter() - started)
+
+
+async def aredis_get_many(
+    client: AnyClient,
+    keys: Sequence[str],
+    deserialize: Optional[Callable[[bytes], T]] = None,
+    default: D = None,
+) -> list[T | D]:
+    if not keys:
+        return []
+    if isinstance(client, ShardedRedis):
+        groups = client.partition(keys)
+        results = await asyncio.gather(*(
+            aredis_get_many(client.nodes[name], [keys[i] for i in indexes], deserialize, default)
+            for name, indexes in groups.items()
+        ))
+        return _unpartition(len(keys), list(groups.values()), results)
+    metrics = get_metrics()
+    started = time.perf_counter()
+    if isinstance(client, AsyncRedis):
+        cached_values = await client.mget(keys)
+    else:
+        cached_values = client.mget(keys)
+    if metrics is not None:
+        metrics.redis_call(keys[0], time.perf_counter() - started)
+    return [
+        _decode(client, key, cached_value, deserialize, default, metrics)
+        for key, cached_value in zip(keys, cached_values)
+    ]
+
+
+def redis_delete(
+    client: Client,
+    key: str,
+    local_cache: Optional[LocalCache] = None,
+) -> None:
+    route(client, key).delete(key)
+    if local_cache is not None:
+        local_cache.discard(key)
+        route(client, local_cache.channel).publish(local_cache.channel, key)
+
+
+async def aredis_delete(
+    client: AnyClient,
+    key: str,
+    local_cache: Optional[LocalCache] = None,
+) -> None:
+    node = route(client, key)
+    if isinstance(node, AsyncRedis):
+        await node.delete(key)
+    else:
+        node.delete(key)
+    if local_cache is not None:
+        local_cache.discard(key)
+        publisher = route(client, local_cache.channel)
+        if isinstance(publisher, AsyncRedis):
+            await publisher.publish(local_cache.channel, key)
         else:
-            raise ValueError("Unsupported type for cached value")
-        try:
-            return deserialize(value)
-        except:
-            return None
-    return None
+            publisher.publish(local_cache.channel, key)
+
+
+def invalidate_tags(
+    client: Client,
+    tags: Iterable[str],
+    local_cache: Optional[LocalCache] = None,
+) -> int:
+    tag_keys = [_tag_key(tag) for tag in tags]
+    if not tag_keys:
+        return 0
+    channel = "" if local_cache is None else local_cache.channel
+    if isinstance(client, ShardedRedis):
+        return _invalidate_sharded_tags(client, tag_keys, channel)
+    script = client.register_script(_INVALIDATE_TAGS_SCRIPT)
+    return int(script(keys=tag_keys, args=[channel]))
+
+
+async def ainvalidate_tags(
+    client: AnyClient,
+    tags: Iterable[str],
+    local_cache: Optional[LocalCache] = None,
+) -> int:
+    if isinstance(client, ShardedRedis):
+        tag_keys = [_tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return 0
+        channel = "" if local_cache is None else local_cache.channel
+        if not any(isinstance(node, AsyncRedis) for node in client.nodes.values()):
+            return _invalidate_sharded_tags(client, tag_keys, channel)
+        return await _ainvalidate_sharded_tags(client, tag_keys, channel)
+    if not isinstance(client, AsyncRedis):
+        return invalidate_tags(client, tags=tags, local_cache=local_cache)
+    tag_keys = [_tag_key(tag) for tag in tags]
+    if not tag_keys:
+        return 0
+    channel = "" if local_cache is None else local_cache.channel
+    script = client.register_script(_INVALIDATE_TAGS_SCRIPT)
+    return int(await script(keys=tag_keys, args=[channel]))
 
 
 @contextmanager
-def acquire_lock(redis: Redis, key: str, expire: int = 60):
+def acquire_lock(redis: Client, key: str, expire: int = 60):
+    redis = route(redis, key)
     lock_acquired = redis.set(key, "locked", nx=True, ex=expire)
     try:
         yield bool(lock_acquired)
     finally:
         if lock_acquired:
-            redis.delete(key)
\ No newline at end of file
+            redis.delete(key)
+
+
+@asynccontextmanager
+async def aacquire_lock(redis: AnyClient, key: str, expire: int = 60):
+    redis = route(redis, key)
+    if isinstance(redis, AsyncRedis):
+        lock_acquired = await redis.set(key, "locked", nx=True, ex=expire)
+    else:
+        lock_acquired = redis.set(key, "locked", nx=True, ex=expire)
+    try:
+        yield bool(lock_acquired)
+    finally:
+        if lock_acquired:
+            if isinstance(redis, AsyncRedis):
+                await redis.delete(key)
+            else:
+                redis.delete(key)
+
+
+class _SingleFlight(Generic[T]):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, "_Call[T]"] = {}
+
+    def do(self, key: str, func: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call[T]()
+        if not leader:
+            return call.wait()
+        try:
+            call.value = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+
+class _Call(Generic[T]):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: T
+        self.error: BaseException | None = None
+
+    def wait(self) -> T:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class _AsyncSingleFlight(Generic[T]):
+
+    def __init__(self):
+        self._calls: dict[tuple[asyncio.AbstractEventLoop, str], asyncio.Task[T]] = {}
+
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        loop = asyncio.get_running_loop()
+        call_key = (loop, key)
+        task = self._calls.get(call_key)
+        if task is None:
+            # the call runs on its own task, so cancelling whichever caller started it cancels no one else
+            task = self._calls[call_key] = loop.create_task(func())
+            task.add_done_callback(functools.partial(self._finish, call_key))
+        return await asyncio.shield(task)
+
+    def _finish(self, call_key: tuple[asyncio.AbstractEventLoop, str], task: "asyncio.Task[T]") -> None:
+        del self._calls[call_key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller was cancelled
+
+
+class _BackgroundRefresh:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: set[str] = set()
+
+    def start(self, key: str, func: Callable[[], Any]) -> None:
+        with self._lock:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+
+        def run() -> None:
+            try:
+                func()
+            finally:
+                with self._lock:
+                    self._keys.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class _AsyncBackgroundRefresh:
+
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def start(self, key: str, func: Callable[[], Awaitable[Any]]) -> None:
+        if key in self._tasks:
+            return
+        task = asyncio.ensure_future(func())
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+
+@dataclass(kw_only=True)
+class _CacheEntry(Generic[T]):
+    value: T
+    delta: float
+    expires_at: float
+
+    @property
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at
+
+    def should_refresh(self, beta: float) -> bool:
+        # XFetch: refresh early with a probability that grows as expiry nears
+        # and with how long the value took to compute
+        jitter = self.delta * beta * -math.log(1.0 - random.random())
+        return time.time() + jitter >= self.expires_at
+
+
+class _EntryCodec(Generic[T]):
+
+    _header = struct.Struct("!dd")
+
+    def __init__(
+        self,
+        expire: Optional[int],
+        stale_ttl: Optional[int],
+        serialize: Optional[Callable[[Any], bytes]],
+        deserialize: Optional[Callable[[bytes], T]],
+    ):
+        if expire is None:
+            raise ValueError("early_refresh and stale_ttl require expire to be set")
+        self.stale_ttl = stale_ttl or 0
+        self._serialize = serialize or default_codec.dumps
+        self._deserialize = deserialize or default_codec.loads
+
+    def expire(self, ttl: int) -> int:
+        return ttl + self.stale_ttl
+
+    def serializer(self, delta: float, ttl: int) -> Callable[[Any], bytes]:
+        expires_at = time.time() + ttl
+        def serialize(value: Any) -> bytes:
+            return self._header.pack(delta, expires_at) + self._serialize(value)
+        return serialize
+
+    def deserialize_entry(self, data: bytes) -> _CacheEntry[T]:
+        delta, expires_at = self._header.unpack_from(data)
+        return _CacheEntry(
+            value=self._deserialize(data[self._header.size:]),
+            delta=delta,
+            expires_at=expires_at,
+        )
+
+    def deserialize_value(self, data: bytes) -> T:
+        return self.deserialize_entry(data).value
+
+
+def _lock_key(key: str) -> str:
+    return f"{key}:lock"
+
+
+def _refresh_lock_key(key: str) -> str:
+    return f"{key}:refresh"
+
+
+def _wait_for_value(
+    client: Client,
+    key: str,
+    timeout: float,
+    deserialize: Optional[Callable[[bytes], T]] = None,
+) -> T | _Missing:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(_LOCK_POLL_INTERVAL)
+        cached_value = _redis_get(client, key, deserialize, MISSING, lookup=False)
+        if cached_value is not MISSING:
+            return cached_value
+    return MISSING
+
+
+async def _await_for_value(
+    client: AnyClient,
+    key: str,
+    timeout: float,
+    deserialize: Optional[Callable[[bytes], T]] = None,
+) -> T | _Missing:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(_LOCK_POLL_INTERVAL)
+        cached_value = await _aredis_get(client, key, deserialize, MISSING, lookup=False)
+        if cached_value is not MISSING:
+            return cached_value
+    return MISSING
+
+
+def _tag_key(tag: str) -> str:
+    return f"{_TAG_PREFIX}{tag}"
+
+
+def _add_tags(client: Client, key: str, tags: Iterable[str], expire: Optional[int]) -> None:
+    for node, tag_keys in _group_by_node(client, [_tag_key(tag) for tag in tags]):
+        script = node.register_script(_ADD_TAGS_SCRIPT)
+        script(keys=tag_keys, args=[key, "" if expire is None else expire])
+
+
+async def _aadd_tags(client: AnyClient, key: str, tags: Iterable[str], expire: Optional[int]) -> None:
+    for node, tag_keys in _group_by_node(client, [_tag_key(tag) for tag in tags]):
+        script = node.register_script(_ADD_TAGS_SCRIPT)
+        if isinstance(node, AsyncRedis):
+            await script(keys=tag_keys, args=[key, "" if expire is None else expire])
+        else:
+            script(keys=tag_keys, args=[key, "" if expire is None else expire])
+
+
+def _invalidate_sharded_tags(client: ShardedRedis[Redis], tag_keys: list[str], channel: str) -> int:
+    members: list[str] = []
+    for node, node_tag_keys in _group_by_node(client, tag_keys):
+        with node.pipeline(transaction=True) as pipe:
+            for tag_key in node_tag_keys:
+                pipe.smembers(tag_key)
+            pipe.delete(*node_tag_keys)
+            results = pipe.execute()
+        members.extend(_decode_members(results[:-1]))
+    deleted = sum(client.run_concurrently([
+        functools.partial(_delete_keys, node, node_members)
+        for node, node_members in _group_by_node(client, members)
+    ]))
+    if channel and members:
+        with client.node(channel).pipeline(transaction=False) as pipe:
+            for member in members:
+                pipe.publish(channel, member)
+            pipe.execute()
+    return deleted
+
+
+async def _ainvalidate_sharded_tags(client: ShardedRedis[AsyncRedis], tag_keys: list[str], channel: str) -> int:
+    members: list[str] = []
+    for node, node_tag_keys in _group_by_node(client, tag_keys):
+        async with node.pipeline(transaction=True) as pipe:
+            for tag_key in node_tag_keys:
+                pipe.smembers(tag_key)
+            pipe.delete(*node_tag_keys)
+            results = await pipe.execute()
+        members.extend(_decode_members(results[:-1]))
+    deleted = await asyncio.gather(*(
+        _adelete_keys(node, node_members)
+        for node, node_members in _group_by_node(client, members)
+    ))
+    if channel and members:
+        async with client.node(channel).pipeline(transaction=False) as pipe:
+            for member in members:
+                pipe.publish(channel, member)
+            await pipe.execute()
+    return sum(deleted)
+
+
+def _delete_keys(client: Redis, keys: list[str]) -> int:
+    return sum(client.delete(*keys[i:i + 5000]) for i in range(0, len(keys), 5000))
+
+
+async def _adelete_keys(client: AsyncRedis, keys: list[str]) -> int:
+    deleted = 0
+    for i in range(0, len(keys), 5000):
+        deleted += await client.delete(*keys[i:i + 5000])
+    return deleted
+
+
+def _decode_members(results: list[set[Any]]) -> list[str]:
+    return [
+        member.decode() if isinstance(member, bytes) else member
+        for result in results
+        for member in result
+    ]
+
+
+def _group_by_node(client: Any, keys: Sequence[str]) -> list[tuple[Any, list[str]]]:
+    if not keys:
+        return []
+    if not isinstance(client, ShardedRedis):
+        return [(client, list(keys))]
+    return [
+        (client.nodes[name], [keys[i] for i in indexes])
+        for name, indexes in client.partition(keys).items()
+    ]
+
+
+def _partition_values(client: ShardedRedis, values: dict[str, Any]) -> dict[str, dict[str, Any]]:
+    groups: dict[str, dict[str, Any]] = {}
+    for key, value in values.items():
+        groups.setdefault(client.node_name(key), {})[key] = value
+    return groups
+
+
+def _unpartition(size: int, groups: list[list[int]], results: Sequence[list[T]]) -> list[T]:
+    merged: list[Any] = [None] * size
+    for indexes, values in zip(groups, results):
+        for i, value in zip(indexes, values):
+            merged[i] = value
+    return merged
+
+
+def _find_misses(keys: Sequence[str], values: Sequence[Any]) -> dict[str, int]:
+    misses: dict[str, int] = {}
+    for i, (key, value) in enumerate(zip(keys, values)):
+        if value is MISSING and key not in misses:
+            misses[key] = i
+    return misses
+
+
+def _check_computed(misses: dict[str, int], computed_values: Sequence[T]) -> dict[str, T]:
+    if len(computed_values) != len(misses):
+        raise ValueError(
+            f"Expected {len(misses)} computed values, got {len(computed_values)}"
+        )
+    return dict(zip(misses.keys(), computed_values))
+
+
+def _ttl_for(value: Any, expire: Optional[int], negative_expire: Optional[int]) -> Optional[int]:
+    if value is None and negative_expire is not None:
+        return negative_expire
+    return expire
+
+
+def _split_negative(computed: dict[str, T], negative_expire: Optional[int]) -> tuple[dict[str, T], dict[str, T]]:
+    if negative_expire is None:
+        return computed, {}
+    positive = {key: value for key, value in computed.items() if value is not None}
+    negative = {key: value for key, value in computed.items() if value is None}
+    return positive, negative
+
+
+def _merge_computed(keys: Sequence[str], values: list[T | _Missing], computed: dict[str, T]) -> list[T]:
+    return [
+        computed[key] if value is MISSING else value
+        for key, value in zip(keys, values)
+    ]  # type: ignore[return-value]
+
+
+def _compute_key(key: str | Callable[P, str], *args: P.args, **kwargs: P.kwargs) -> str:
+    if isinstance(key, str):
+        return key
+    return key(*args, **kwargs)
+
+
+def _encode(
+    key: str,
+    value: Any,
+    serialize: Optional[Callable[[Any], bytes]],
+    metrics: Optional[CacheMetrics],
+) -> bytes:
+    if serialize is None:
+        serialize = default_codec.dumps
+    if metrics is None:
+        return serialize(value)
+    started = time.perf_counter()
+    data = serialize(value)
+    metrics.write(key, len(data), time.perf_counter() - started)
+    return data
+
+
+def _decode(
+    client: AnyClient,
+    key: str,
+    cached_value: Any,
+    deserialize: Optional[Callable[[bytes], T]] = None,
+    default: D = None,
+    metrics: Optional[CacheMetrics] = None,
+    lookup: bool = True,
+) -> T | D:
+    # polls and re-checks read the same logical lookup again, so only its first read is counted
+    if deserialize is None:
+        deserialize = default_codec.loads
+    if cached_value is None:
+        if metrics is not None and lookup:
+            metrics.miss(key)
+        return default
+    if isinstance(cached_value, bytes):
+        value = cached_value
+    elif isinstance(cached_value, str):
+        value = client.get_encoder().encode(cached_value)
+    else:
+        raise ValueError("Unsupported type for cached value")
+    started = time.perf_counter()
+    try:
+        result = deserialize(value)
+    except ImportError:
+        raise
+    except Exception:
+        logger.warning("Failed to deserialize cached value for %s", key, exc_info=True)
+        if metrics is not None:
+            metrics.deserialize_error(key, len(value))
+        return default
+    if metrics is not None and lookup:
+        metrics.hit(key, len(value), time.perf_counter() - started)
+    return result
@@ -0,0 +1,144 @@
+import importlib
+import pickle
+from typing import Any, Callable, Literal, Optional
+
+
+__all__ = [
+    "Codec",
+    "CodecError",
+    "default_codec",
+]
+
+Format = Literal["pickle", "msgpack", "orjson"]
+Compression = Literal["zstd", "lz4"]
+
+# every encoded value starts with MAGIC + format tag + compression tag
+_MAGIC = b"\xfeU"
+_HEADER_SIZE = len(_MAGIC) + 2
+
+_FORMAT_TAGS: dict[str, bytes] = {
+    "pickle": b"p",
+    "msgpack": b"m",
+    "orjson": b"j",
+}
+_COMPRESSION_TAGS: dict[str | None, bytes] = {
+    None: b"-",
+    "zstd": b"z",
+    "lz4": b"4",
+}
+_FORMATS_BY_TAG = {tag: name for name, tag in _FORMAT_TAGS.items()}
+_COMPRESSIONS_BY_TAG = {tag: name for name, tag in _COMPRESSION_TAGS.items()}
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec:
+
+    def __init__(
+        self,
+        format: Format = "pickle",
+        compression: Optional[Compression] = None,
+        compress_threshold: int = 1024,
+        compress_level: Optional[int] = None,
+    ):
+        if format not in _FORMAT_TAGS:
+            raise ValueError(f"Unsupported format: {format}")
+        if compression not in _COMPRESSION_TAGS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.format = format
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self._dumps = _dumps_for(format)
+        self._compress = None if compression is None else _compress_for(compression, compress_level)
+
+    def dumps(self, value: Any) -> bytes:
+        payload = self._dumps(value)
+        compression = None
+        if self._compress is not None and len(payload) >= self.compress_threshold:
+            payload = self._compress(payload)
+            compression = self.compression
+        return _MAGIC + _FORMAT_TAGS[self.format] + _COMPRESSION_TAGS[compression] + payload
+
+    def loads(self, data: bytes) -> Any:
+        return decode(data)
+
+
+def decode(data: bytes) -> Any:
+    if not data.startswith(_MAGIC):
+        # values written before the codec header existed are bare pickles
+        return pickle.loads(data)
+    if len(data) < _HEADER_SIZE:
+        raise CodecError("Truncated codec header")
+    format_tag = data[len(_MAGIC):len(_MAGIC) + 1]
+    compression_tag = data[len(_MAGIC) + 1:_HEADER_SIZE]
+    if format_tag not in _FORMATS_BY_TAG:
+        raise CodecError(f"Unknown format tag: {format_tag!r}")
+    if compression_tag not in _COMPRESSIONS_BY_TAG:
+        raise CodecError(f"Unknown compression tag: {compression_tag!r}")
+    payload = data[_HEADER_SIZE:]
+    compression = _COMPRESSIONS_BY_TAG[compression_tag]
+    if compression is not None:
+        payload = _decompress_for(compression)(payload)
+    return _loads_for(_FORMATS_BY_TAG[format_tag])(payload)
+
+
+def _dumps_for(format: str) -> Callable[[Any], bytes]:
+    if format == "pickle":
+        return lambda value: pickle.dumps(value, protocol=5)
+    if format == "msgpack":
+        msgpack = _require("msgpack", "msgpack")
+        return lambda value: msgpack.packb(value, use_bin_type=True)
+    if format == "orjson":
+        orjson = _require("orjson", "orjson")
+        return orjson.dumps
+    raise ValueError(f"Unsupported format: {format}")
+
+
+def _loads_for(format: str) -> Callable[[bytes], Any]:
+    if format == "pickle":
+        return pickle.loads
+    if format == "msgpack":
+        msgpack = _require("msgpack", "msgpack")
+        return lambda payload: msgpack.unpackb(payload, raw=False)
+    if format == "orjson":
+        orjson = _require("orjson", "orjson")
+        return orjson.loads
+    raise ValueError(f"Unsupported format: {format}")
+
+
+def _compress_for(compression: str, level: Optional[int]) -> Callable[[bytes], bytes]:
+    if compression == "zstd":
+        zstandard = _require("zstandard", "zstd")
+        level = 3 if level is None else level
+        # zstandard contexts are not thread safe, so one is created per call
+        return lambda payload: zstandard.ZstdCompressor(level=level).compress(payload)
+    if compression == "lz4":
+        lz4_frame = _require("lz4.frame", "lz4")
+        return lambda payload: lz4_frame.compress(payload, compression_level=level or 0)
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def _decompress_for(compression: str) -> Callable[[bytes], bytes]:
+    if compression == "zstd":
+        zstandard = _require("zstandard", "zstd")
+        return lambda payload: zstandard.ZstdDecompressor().decompress(payload)
+    if compression == "lz4":
+        lz4_frame = _require("lz4.frame", "lz4")
+        return lz4_frame.decompress
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def _require(module: str, extra: str) -> Any:
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError(
+            f"The '{extra}' codec requires the '{module}' module. "
+            f"Install the optional dependency with: pip install unboil-redis[{extra}]"
+        ) from e
+
+
+default_codec = Codec()
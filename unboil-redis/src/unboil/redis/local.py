@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+from redis import Redis
+from redis.client import PubSubWorkerThread
+from typing import Any, Generic, Optional, TypeVar
+from .sharding import ShardedRedis, route
+
+
+__all__ = [
+    "LocalCache",
+]
+
+T = TypeVar("T")
+D = TypeVar("D")
+
+
+class LocalCache(Generic[T]):
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        client: Optional[Redis | ShardedRedis[Redis]] = None,
+        channel: str = "unboil:redis:invalidate",
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = channel
+        # with a sharded client, the channel is routed to one node like a key
+        self._client = None if client is None else route(client, channel)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[T, float | None]] = OrderedDict()
+        self._subscriber: PubSubWorkerThread | None = None
+        if self._client is not None:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: self._on_message})
+            self._subscriber = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def get(self, key: str, default: D = None) -> T | D:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: T, expire: Optional[float] = None) -> None:
+        ttl = _min_ttl(self.ttl, expire)
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate(self, key: str) -> None:
+        self.discard(key)
+        if self._client is not None:
+            self._client.publish(self.channel, key)
+
+    def close(self) -> None:
+        if self._subscriber is not None:
+            self._subscriber.stop()
+            self._subscriber = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _on_message(self, message: dict[str, Any]) -> None:
+        key = message["data"]
+        if isinstance(key, bytes):
+            key = key.decode()
+        self.discard(key)
+
+
+def _min_ttl(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
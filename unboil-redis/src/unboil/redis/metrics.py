@@ -0,0 +1,158 @@
+import threading
+from dataclasses import dataclass, replace
+from typing import Callable, Literal, Optional
+
+
+__all__ = [
+    "CacheMetrics",
+    "CacheStats",
+    "CacheEvent",
+    "enable_metrics",
+    "disable_metrics",
+    "get_metrics",
+]
+
+CacheEventKind = Literal[
+    "hit",
+    "miss",
+    "local_hit",
+    "deserialize_error",
+    "redis_call",
+    "write",
+]
+
+
+@dataclass(kw_only=True)
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    local_hits: int = 0
+    deserialize_errors: int = 0
+    redis_calls: int = 0
+    redis_time: float = 0.0
+    serialize_time: float = 0.0
+    deserialize_time: float = 0.0
+    bytes_read: int = 0
+    bytes_written: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.local_hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return (self.hits + self.local_hits) / lookups
+
+
+@dataclass(kw_only=True)
+class CacheEvent:
+    kind: CacheEventKind
+    key: str
+    prefix: str
+    duration: float = 0.0
+    size: int = 0
+
+
+class CacheMetrics:
+
+    def __init__(
+        self,
+        prefix: Optional[Callable[[str], str]] = None,
+        callback: Optional[Callable[[CacheEvent], None]] = None,
+    ):
+        self._prefix = prefix or _default_prefix
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._stats: dict[str, CacheStats] = {}
+
+    def stats(self) -> dict[str, CacheStats]:
+        with self._lock:
+            return {prefix: replace(stats) for prefix, stats in self._stats.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def hit(self, key: str, size: int, deserialize_time: float) -> None:
+        prefix = self._prefix(key)
+        with self._lock:
+            stats = self._get(prefix)
+            stats.hits += 1
+            stats.bytes_read += size
+            stats.deserialize_time += deserialize_time
+        self._emit("hit", key, prefix, deserialize_time, size)
+
+    def miss(self, key: str) -> None:
+        prefix = self._prefix(key)
+        with self._lock:
+            self._get(prefix).misses += 1
+        self._emit("miss", key, prefix)
+
+    def local_hit(self, key: str) -> None:
+        prefix = self._prefix(key)
+        with self._lock:
+            self._get(prefix).local_hits += 1
+        self._emit("local_hit", key, prefix)
+
+    def deserialize_error(self, key: str, size: int) -> None:
+        prefix = self._prefix(key)
+        with self._lock:
+            stats = self._get(prefix)
+            stats.deserialize_errors += 1
+            stats.misses += 1
+            stats.bytes_read += size
+        self._emit("deserialize_error", key, prefix, size=size)
+
+    def redis_call(self, key: str, duration: float) -> None:
+        prefix = self._prefix(key)
+        with self._lock:
+            stats = self._get(prefix)
+            stats.redis_calls += 1
+            stats.redis_time += duration
+        self._emit("redis_call", key, prefix, duration)
+
+    def write(self, key: str, size: int, serialize_time: float) -> None:
+        prefix = self._prefix(key)
+        with self._lock:
+            stats = self._get(prefix)
+            stats.bytes_written += size
+            stats.serialize_time += serialize_time
+        self._emit("write", key, prefix, serialize_time, size)
+
+    def _get(self, prefix: str) -> CacheStats:
+        stats = self._stats.get(prefix)
+        if stats is None:
+            stats = self._stats[prefix] = CacheStats()
+        return stats
+
+    def _emit(
+        self,
+        kind: CacheEventKind,
+        key: str,
+        prefix: str,
+        duration: float = 0.0,
+        size: int = 0,
+    ) -> None:
+        if self._callback is not None:
+            self._callback(CacheEvent(kind=kind, key=key, prefix=prefix, duration=duration, size=size))
+
+
+_metrics: Optional[CacheMetrics] = None
+
+
+def enable_metrics(metrics: Optional[CacheMetrics] = None) -> CacheMetrics:
+    global _metrics
+    _metrics = metrics or CacheMetrics()
+    return _metrics
+
+
+def disable_metrics() -> None:
+    global _metrics
+    _metrics = None
+
+
+def get_metrics() -> Optional[CacheMetrics]:
+    return _metrics
+
+
+def _default_prefix(key: str) -> str:
+    return key.split(":", 1)[0]
@@ -0,0 +1,107 @@
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from typing import Any, Callable, Generic, Mapping, Sequence, TypeVar
+
+
+__all__ = [
+    "ShardedRedis",
+]
+
+T = TypeVar("T")
+TClient = TypeVar("TClient", Redis, AsyncRedis)
+
+
+class ShardedRedis(Generic[TClient]):
+
+    def __init__(
+        self,
+        nodes: Sequence[TClient] | Mapping[str, TClient],
+        vnodes: int = 160,
+    ):
+        if isinstance(nodes, Mapping):
+            self.nodes: dict[str, TClient] = dict(nodes)
+        else:
+            self.nodes = {_node_name(node): node for node in nodes}
+        if not self.nodes:
+            raise ValueError("ShardedRedis requires at least one node")
+        ring = sorted(
+            (_hash(f"{name}#{i}"), name)
+            for name in self.nodes
+            for i in range(vnodes)
+        )
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_names = [name for _, name in ring]
+        self._executor: ThreadPoolExecutor | None = None
+
+    def node_name(self, key: str) -> str:
+        index = bisect.bisect(self._ring_hashes, _hash(_hash_slot(key)))
+        return self._ring_names[index % len(self._ring_names)]
+
+    def node(self, key: str) -> TClient:
+        return self.nodes[self.node_name(key)]
+
+    def partition(self, keys: Sequence[str]) -> dict[str, list[int]]:
+        groups: dict[str, list[int]] = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.node_name(key), []).append(i)
+        return groups
+
+    def run_concurrently(self, calls: Sequence[Callable[[], T]]) -> list[T]:
+        if len(calls) <= 1:
+            return [call() for call in calls]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self.nodes),
+                thread_name_prefix="unboil-redis-shard",
+            )
+        return list(self._executor.map(lambda call: call(), calls))
+
+    def get(self, key: str) -> Any:
+        return self.node(key).get(key)
+
+    def set(self, key: str, value: Any, **kwargs: Any) -> Any:
+        return self.node(key).set(key, value, **kwargs)
+
+    def delete(self, key: str) -> Any:
+        return self.node(key).delete(key)
+
+    def publish(self, channel: str, message: Any) -> Any:
+        return self.node(channel).publish(channel, message)
+
+    def get_encoder(self) -> Any:
+        return next(iter(self.nodes.values())).get_encoder()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def route(client: Any, key: str) -> Any:
+    if isinstance(client, ShardedRedis):
+        return client.node(key)
+    return client
+
+
+def _hash_slot(key: str) -> str:
+    # honour Redis Cluster style hash tags so related keys can share a node
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def _node_name(node: Redis | AsyncRedis) -> str:
+    kwargs = node.connection_pool.connection_kwargs
+    if "path" in kwargs:
+        return f"{kwargs['path']}/{kwargs.get('db', 0)}"
+    return f"{kwargs.get('host', 'localhost')}:{kwargs.get('port', 6379)}/{kwargs.get('db', 0)}"
@@ -1,9 +1,26 @@
+from contextlib import aclosing
 from dataclasses import dataclass
+import asyncio
+import base64
+import binascii
+import json
 import math
+import operator
+import threading
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+from time import monotonic
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import Session
-from sqlalchemy import Select, func, select
-from typing import AsyncIterable, Generic, Sequence, TypeVar
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import ONETOMANY, InstanceState, Mapper, Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+from sqlalchemy import delete as sql_delete
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy import ColumnElement, Result, Row, Select, Table, UnaryExpression, func, insert, select, tuple_
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.sql.operators import asc_op, desc_op
+from typing import Any, AsyncIterable, AsyncIterator, Generic, Iterator, Literal, Sequence, TypeVar, cast
 
 T = TypeVar("T")
 TTuple = TypeVar("TTuple", bound=tuple)
@@ -23,6 +40,40 @@ async def fetch_all(db: AsyncSession | Session, query: Select[tuple[T]]) -> Sequ
         return db.execute(query).scalars().all()
 
 
+async def fetch_stream(
+    db: AsyncSession | Session,
+    query: Select[tuple[T]],
+    chunk_size: int = 1000,
+) -> AsyncIterator[T]:
+    async with aclosing(fetch_stream_chunks(db, query, chunk_size=chunk_size)) as chunks:
+        async for chunk in chunks:
+            for item in chunk:
+                yield item
+
+
+async def fetch_stream_chunks(
+    db: AsyncSession | Session,
+    query: Select[tuple[T]],
+    chunk_size: int = 1000,
+) -> AsyncIterator[Sequence[T]]:
+    # yield_per streams through a server-side cursor where the driver supports one
+    query = query.execution_options(yield_per=chunk_size)
+    if isinstance(db, AsyncSession):
+        async_result = await db.stream_scalars(query)
+        try:
+            async for chunk in async_result.partitions():
+                yield chunk
+        finally:
+            await async_result.close()
+    else:
+        result = db.execute(query).scalars()
+        try:
+            for chunk in result.partitions():
+                yield chunk
+        finally:
+            result.close()
+
+
 async def count(db: AsyncSession | Session, query: Select[TTuple]) -> int:
     count_query = select(func.count()).select_from(query.alias())
     return await fetch_one(db, count_query) or 0
@@ -32,43 +83,216 @@ async def save(
     db: AsyncSession | Session,
     instances: list[object],
     auto_commit: bool = True,
+    bulk: bool = False,
+    upsert: bool = False,
 ) -> None:
-    db.add_all(instances)
+    if not (bulk or upsert):
+        db.add_all(instances)
+        if auto_commit:
+            await _commit(db)
+            await _reload(db, instances)
+        return
+    inserted: list[tuple[object, dict[str, Any]]] = []
+    others: list[object] = []
+    for mapper, group in _group_by_mapper(instances).items():
+        rows: list[object] = []
+        for instance in group:
+            if _bulk_insertable(mapper, instance_state(instance), upsert):
+                rows.append(instance)
+            else:
+                others.append(instance)
+        if rows:
+            inserted.extend(await _bulk_insert(db, mapper, rows, upsert))
+    db.add_all(others)
     if auto_commit:
-        if isinstance(db, AsyncSession):
-            await db.commit()
-            for instance in instances:
-                await db.refresh(instance)
-        else:
-            db.commit()
-            for instance in instances:
-                db.refresh(instance)
+        await _commit(db)
+        # commit expired the attributes; put back what RETURNING already gave us
+        for instance, values in inserted:
+            for key, value in values.items():
+                set_committed_value(instance, key, value)
+        await _reload(db, others)
 
 
 async def delete(
     db: AsyncSession | Session,
     instances: list[object],
     auto_commit: bool = True,
+    chunk_size: int = 1000,
 ) -> None:
+    others: list[object] = []
+    for mapper, group in _group_by_mapper(instances).items():
+        if not _bulk_deletable(mapper):
+            others.extend(group)
+            continue
+        persisted: list[tuple[tuple[Any, ...], object]] = []
+        for instance in group:
+            state = instance_state(instance)
+            if state.identity is not None:
+                persisted.append((state.identity, instance))
+            elif state.session_id is not None:
+                # pending objects have no row yet, so forgetting them is enough
+                db.expunge(instance)
+        # with auto_commit each chunk commits on its own so locks are held briefly
+        for chunk in _chunks(persisted, chunk_size):
+            await _execute(db, mapper.local_table.delete().where(_pk_in(mapper, [identity for identity, _ in chunk])))
+            # the rows were deleted behind the unit of work, so the session must forget them
+            for _, instance in chunk:
+                if instance_state(instance).session_id is not None:
+                    db.expunge(instance)
+            if auto_commit:
+                await _commit(db)
     if isinstance(db, AsyncSession):
-        for instance in instances:
+        for instance in others:
             await db.delete(instance)
-        if auto_commit:
-            await db.commit()
     else:
-        for instance in instances:
+        for instance in others:
             db.delete(instance)
+    if auto_commit and others:
+        await _commit(db)
+
+
+async def delete_where(
+    db: AsyncSession | Session,
+    model: type[Any],
+    *criteria: ColumnElement[bool],
+    auto_commit: bool = True,
+    chunk_size: int | None = 1000,
+) -> int:
+    mapper: Mapper[Any] = sa_inspect(model)
+    if len(mapper.tables) != 1:
+        raise ValueError(f"delete_where does not support {model.__name__}, which spans several tables")
+    table = mapper.local_table
+    if chunk_size is None:
+        # the ORM-enabled delete adds the discriminator of single-table subclasses
+        statement = sql_delete(model).where(*criteria).execution_options(synchronize_session=False)
+        deleted = _rowcount(await _execute(db, statement))
         if auto_commit:
-            db.commit()
+            await _commit(db)
+        return deleted
+    # selecting the mapped attributes, not the raw columns, keeps single-table subclasses filtered
+    pk_attributes = [getattr(model, mapper.get_property_by_column(column).key) for column in mapper.primary_key]
+    deleted = 0
+    while True:
+        # only the primary keys of the next chunk are read, never whole rows
+        pk_query = select(*pk_attributes).where(*criteria).limit(chunk_size)
+        identities = [tuple(row) for row in await _fetch_rows(db, pk_query)]
+        if identities:
+            deleted += _rowcount(await _execute(db, table.delete().where(_pk_in(mapper, identities))))
+            if auto_commit:
+                await _commit(db)
+        if len(identities) < chunk_size:
+            return deleted
+
+
+class DataLoader(Generic[T]):
+
+    def __init__(
+        self,
+        db: AsyncSession | Session,
+        model: type[T],
+        column: Any = None,
+        max_batch_size: int = 1000,
+    ):
+        mapper: Mapper[Any] = sa_inspect(model)
+        if column is None:
+            if len(mapper.primary_key) != 1:
+                raise ValueError("DataLoader needs a column for models with a composite primary key")
+            column = getattr(model, mapper.get_property_by_column(mapper.primary_key[0]).key)
+        self.db = db
+        self.model = model
+        self.column = column
+        self.max_batch_size = max_batch_size
+        self._key_type = _python_type(column)
+        self._memo: dict[Any, asyncio.Future[T | None]] = {}
+        self._pending: dict[Any, asyncio.Future[T | None]] = {}
+        self._lock = asyncio.Lock()
+
+    async def load(self, key: Any) -> T | None:
+        key = self._normalize(key)
+        future = self._memo.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._memo[key] = loop.create_future()
+            if not self._pending:
+                # every load() issued before the loop gets back to us joins this batch
+                loop.call_soon(self._dispatch)
+            self._pending[key] = future
+        return await future
+
+    async def load_many(self, keys: Sequence[Any]) -> list[T | None]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def prime(self, key: Any, value: T | None) -> None:
+        key = self._normalize(key)
+        if key not in self._memo:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(value)
+            self._memo[key] = future
+
+    def clear(self, key: Any = None) -> None:
+        if key is None:
+            self._memo.clear()
+        else:
+            self._memo.pop(self._normalize(key), None)
+
+    def _normalize(self, key: Any) -> Any:
+        if self._key_type is uuid.UUID and isinstance(key, str):
+            return uuid.UUID(key)
+        return key
+
+    def _dispatch(self) -> None:
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._load_batches(pending))
+
+    async def _load_batches(self, pending: dict[Any, asyncio.Future[T | None]]) -> None:
+        # a session runs one statement at a time, so batches from every tick are loaded in turn
+        try:
+            async with self._lock:
+                for chunk in _chunks(list(pending), self.max_batch_size):
+                    await self._load_batch({key: pending[key] for key in chunk})
+        finally:
+            for key, future in pending.items():
+                if not future.done():
+                    self._memo.pop(key, None)
+                    future.cancel()
+
+    async def _load_batch(self, batch: dict[Any, asyncio.Future[T | None]]) -> None:
+        try:
+            results = await fetch_all(self.db, select(self.model).where(self.column.in_(list(batch))))
+        except BaseException as e:
+            for key, future in batch.items():
+                # failed keys are not memoized so a later load can retry
+                if self._memo.get(key) is future:
+                    del self._memo[key]
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        found = {getattr(result, self.column.key): result for result in results}
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+
+def _python_type(column: Any) -> type | None:
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return None
+
+
+TotalStrategy = Literal["exact", "none", "window", "estimate", "cached"]
 
 
 @dataclass(kw_only=True)
 class PaginatedResult(Generic[T]):
     has_more: bool
-    total: int
+    total: int | None
     offset: int
     limit: int | None
     items: list[T]
+    next_cursor: str | None = None
 
     @property
     def current_page(self) -> int:
@@ -77,9 +301,11 @@ class PaginatedResult(Generic[T]):
         return math.ceil((self.offset - 1) / self.limit) + 1
 
     @property
-    def total_pages(self) -> int:
+    def total_pages(self) -> int | None:
         if self.limit is None:
             return 1
+        if self.total is None:
+            return None
         return math.ceil((self.total - 1) / self.limit) + 1
 
 
@@ -88,19 +314,34 @@ async def paginate(
     query: Select[tuple[T]],
     offset: int = 0,
     limit: int | None = None,
+    keyset: Sequence[ColumnElement[Any]] | None = None,
+    cursor: str | None = None,
+    total: TotalStrategy = "exact",
+    total_ttl: float = 60.0,
 ) -> PaginatedResult[T]:
-    total = await count(db=db, query=query)
-    query = query.offset(offset)
-    if limit is not None:
-        query = query.limit(limit + 1)
-    results = await fetch_all(db=db, query=query)
-    has_more = limit is not None and len(results) > limit
+    # after a cursor the window count would only cover the remaining rows
+    window = total == "window" and cursor is None
+    row_total = None if window else await _count_total(db, query, total, total_ttl)
+    next_cursor = None
+    if keyset is not None:
+        items, has_more, next_cursor, window_total = await _fetch_keyset_page(db, query, keyset, cursor, limit, window)
+    else:
+        items, has_more, window_total = await _fetch_offset_page(db, query, offset, limit, window)
+    if window:
+        # an empty page carries no count, which is only conclusive on the first page
+        if window_total is not None:
+            row_total = window_total
+        elif offset == 0 or keyset is not None:
+            row_total = 0
+        else:
+            row_total = await count(db=db, query=query)
     return PaginatedResult(
         has_more=has_more,
-        total=total or 0,
+        total=row_total,
         limit=limit,
         offset=offset,
-        items=list(results[:-1]) if has_more else list(results),
+        items=items,
+        next_cursor=next_cursor,
     )
 
 
@@ -108,22 +349,348 @@ async def iter_pages(
     db: AsyncSession | Session,
     query: Select[tuple[T]],
     page_size: int = 1000,
+    keyset: Sequence[ColumnElement[Any]] | None = None,
+    total: TotalStrategy = "exact",
+    total_ttl: float = 60.0,
 ) -> AsyncIterable[PaginatedResult[T]]:
     
-    offset = 0
-    total = await count(db=db, query=query)
+    page = await paginate(db, query, limit=page_size, keyset=keyset, total=total, total_ttl=total_ttl)
     while True:
-        query = query.offset(offset)
-        query = query.limit(page_size + 1)
-        results = await fetch_all(db=db, query=query)
-        has_more = len(results) > page_size
-        yield PaginatedResult(
-            has_more=has_more,
-            total=total or 0,
+        yield page
+        if not page.has_more:
+            break
+        # the total is only computed for the first page
+        next_page = await paginate(
+            db,
+            query,
+            offset=page.offset + page_size,
             limit=page_size,
-            offset=offset,
-            items=list(results[:-1]) if has_more else list(results),
+            keyset=keyset,
+            cursor=page.next_cursor,
+            total="none",
         )
-        if not has_more:
-            break
-        offset += page_size
\ No newline at end of file
+        next_page.total = page.total
+        page = next_page
+
+
+async def _count_total(
+    db: AsyncSession | Session,
+    query: Select[Any],
+    strategy: TotalStrategy,
+    ttl: float,
+) -> int | None:
+    if strategy == "none":
+        return None
+    if strategy == "estimate":
+        return await _estimate_count(db, query)
+    if strategy == "cached":
+        key = _count_cache_key(db, query)
+        cached_total = _count_cache.get(key)
+        if cached_total is None:
+            cached_total = await count(db=db, query=query)
+            _count_cache.set(key, cached_total, ttl)
+        return cached_total
+    return await count(db=db, query=query)
+
+
+async def _estimate_count(db: AsyncSession | Session, query: Select[Any]) -> int:
+    if db.get_bind().dialect.name != "postgresql":
+        return await count(db=db, query=query)
+    plan = await fetch_one(db, cast(Select[tuple[Any]], _Explain(query)))
+    if isinstance(plan, (str, bytes)):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class _Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, query: Select[Any]):
+        self.query = query
+
+
+@compiles(_Explain, "postgresql")
+def _compile_explain(element: _Explain, compiler: Any, **kw: Any) -> str:
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.query, **kw)
+
+
+class _CountCache:
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[int, float]] = {}
+
+    def get(self, key: str) -> int | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= monotonic():
+                return None
+            return entry[0]
+
+    def set(self, key: str, value: int, ttl: float) -> None:
+        now = monotonic()
+        with self._lock:
+            if len(self._entries) >= self.maxsize:
+                self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+                while len(self._entries) >= self.maxsize:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[key] = (value, now + ttl)
+
+
+_count_cache = _CountCache()
+
+
+def _count_cache_key(db: AsyncSession | Session, query: Select[Any]) -> str:
+    bind = db.get_bind()
+    compiled = query.compile(dialect=bind.dialect)
+    return f"{bind.engine.url.render_as_string()}|{compiled}|{sorted(compiled.params.items(), key=lambda item: item[0])!r}"
+
+
+async def _fetch_rows(db: AsyncSession | Session, query: Select[Any]) -> Sequence[Row[Any]]:
+    if isinstance(db, AsyncSession):
+        return (await db.execute(query)).all()
+    else:
+        return db.execute(query).all()
+
+
+async def _fetch_offset_page(
+    db: AsyncSession | Session,
+    query: Select[tuple[T]],
+    offset: int,
+    limit: int | None,
+    window: bool,
+) -> tuple[list[T], bool, int | None]:
+    query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    if not window:
+        results = await fetch_all(db=db, query=query)
+        has_more = limit is not None and len(results) > limit
+        return list(results[:-1]) if has_more else list(results), has_more, None
+    rows = await _fetch_rows(db, query.add_columns(func.count().over()))
+    has_more = limit is not None and len(rows) > limit
+    if has_more:
+        rows = rows[:-1]
+    return [row[0] for row in rows], has_more, rows[0][-1] if rows else None
+
+
+async def _fetch_keyset_page(
+    db: AsyncSession | Session,
+    query: Select[tuple[T]],
+    keyset: Sequence[ColumnElement[Any]],
+    cursor: str | None,
+    limit: int | None,
+    window: bool = False,
+) -> tuple[list[T], bool, str | None, int | None]:
+    columns, descending = _keyset_columns(keyset)
+    # the keyset fully defines the order and is selected alongside each row
+    query = query.order_by(None).order_by(*keyset).add_columns(*columns)
+    if window:
+        query = query.add_columns(func.count().over())
+    if cursor is not None:
+        compare = operator.lt if descending else operator.gt
+        values = _decode_cursor(cursor, len(columns))
+        if len(columns) == 1:
+            query = query.where(compare(columns[0], values[0]))
+        else:
+            query = query.where(compare(tuple_(*columns), tuple_(*values)))
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = await _fetch_rows(db, query)
+    has_more = limit is not None and len(rows) > limit
+    if has_more:
+        rows = rows[:-1]
+    key_end = len(columns) + 1
+    next_cursor = _encode_cursor(rows[-1][1:key_end]) if has_more else None
+    window_total = rows[0][-1] if window and rows else None
+    return [row[0] for row in rows], has_more, next_cursor, window_total
+
+
+def _keyset_columns(keyset: Sequence[ColumnElement[Any]]) -> tuple[list[ColumnElement[Any]], bool]:
+    if not keyset:
+        raise ValueError("keyset requires at least one column")
+    columns: list[ColumnElement[Any]] = []
+    directions: set[bool] = set()
+    for column in keyset:
+        if isinstance(column, UnaryExpression) and column.modifier in (asc_op, desc_op):
+            directions.add(column.modifier is desc_op)
+            column = column.element
+        else:
+            directions.add(False)
+        columns.append(column)
+    if len(directions) > 1:
+        raise ValueError("keyset columns must all be ascending or all be descending")
+    return columns, directions.pop()
+
+
+def _encode_cursor(values: Sequence[Any]) -> str:
+    payload = json.dumps([_encode_cursor_value(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, size: int) -> list[Any]:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = [_decode_cursor_value(value) for value in json.loads(payload)]
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid pagination cursor") from e
+    if len(values) != size:
+        raise ValueError("Invalid pagination cursor")
+    return values
+
+
+# json has no native type for these, so they are tagged to round-trip exactly
+_CURSOR_TYPES: dict[str, tuple[type, Any]] = {
+    "uuid": (uuid.UUID, uuid.UUID),
+    "datetime": (datetime, datetime.fromisoformat),
+    "date": (date, date.fromisoformat),
+    "time": (time, time.fromisoformat),
+    "decimal": (Decimal, Decimal),
+}
+
+
+def _encode_cursor_value(value: Any) -> Any:
+    for tag, (type_, _) in _CURSOR_TYPES.items():
+        if isinstance(value, type_):
+            return {tag: value.isoformat() if hasattr(value, "isoformat") else str(value)}
+    return value
+
+
+def _decode_cursor_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        (tag, raw), = value.items()
+        return _CURSOR_TYPES[tag][1](raw)
+    return value
+
+
+async def _execute(db: AsyncSession | Session, statement: Any, params: Any = None) -> Result[Any]:
+    if isinstance(db, AsyncSession):
+        return await db.execute(statement, params)
+    else:
+        return db.execute(statement, params)
+
+
+async def _commit(db: AsyncSession | Session) -> None:
+    if isinstance(db, AsyncSession):
+        await db.commit()
+    else:
+        db.commit()
+
+
+def _group_by_mapper(instances: Sequence[object]) -> dict[Mapper[Any], list[object]]:
+    groups: dict[Mapper[Any], list[object]] = {}
+    for instance in instances:
+        groups.setdefault(instance_state(instance).mapper, []).append(instance)
+    return groups
+
+
+def _chunks(items: Sequence[T], size: int) -> Iterator[Sequence[T]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def _reload(db: AsyncSession | Session, instances: Sequence[object], chunk_size: int = 1000) -> None:
+    # one SELECT ... WHERE pk IN (...) per mapper instead of a refresh per instance
+    for mapper, group in _group_by_mapper(instances).items():
+        # the identity key is known without loading the expired attributes
+        identities = [
+            identity for identity in (instance_state(instance).identity for instance in group)
+            if identity is not None
+        ]
+        for chunk in _chunks(identities, chunk_size):
+            query = select(mapper).where(_pk_in(mapper, chunk)).execution_options(populate_existing=True)
+            await fetch_all(db, query)
+
+
+def _pk_in(mapper: Mapper[Any], identities: Sequence[tuple[Any, ...]]) -> ColumnElement[bool]:
+    if len(mapper.primary_key) == 1:
+        return mapper.primary_key[0].in_([identity[0] for identity in identities])
+    return tuple_(*mapper.primary_key).in_(identities)
+
+
+def _bulk_deletable(mapper: Mapper[Any]) -> bool:
+    # inheritance spanning several tables and relationships that act on delete need the unit of work:
+    # cascades, association rows and children whose foreign keys get nulled
+    if len(mapper.tables) != 1:
+        return False
+    for relationship in mapper.relationships:
+        if relationship.cascade.delete or relationship.secondary is not None:
+            return False
+        if relationship.direction is ONETOMANY and not relationship.passive_deletes:
+            return False
+    return True
+
+
+def _rowcount(result: Result[Any]) -> int:
+    return max(getattr(result, "rowcount", 0), 0)
+
+
+def _bulk_insertable(mapper: Mapper[Any], state: InstanceState[Any], upsert: bool) -> bool:
+    # inheritance spanning several tables and objects the session already tracks stay on the ORM path
+    if len(mapper.tables) != 1:
+        return False
+    if not (state.transient or (upsert and state.detached)):
+        return False
+    # pending relationship changes (association rows, foreign keys) are only written by a flush
+    return not any(state.attrs[relationship.key].history.has_changes() for relationship in mapper.relationships)
+
+
+async def _bulk_insert(
+    db: AsyncSession | Session,
+    mapper: Mapper[Any],
+    instances: Sequence[object],
+    upsert: bool,
+) -> list[tuple[object, dict[str, Any]]]:
+    table = mapper.local_table
+    columns = [(prop.key, prop.columns[0]) for prop in mapper.column_attrs if prop.columns[0].table is table]
+    # executemany needs the same keys in every row, so rows are grouped by which attributes are set
+    groups: dict[tuple[str, ...], list[tuple[object, dict[str, Any]]]] = {}
+    for instance in instances:
+        state = instance_state(instance)
+        row = {column.key: state.dict[key] for key, column in columns if key in state.dict}
+        groups.setdefault(tuple(row), []).append((instance, row))
+    inserted: list[tuple[object, dict[str, Any]]] = []
+    for keys, rows in groups.items():
+        statement = _insert_statement(db, cast(Table, table), keys, upsert).returning(
+            *table.columns, sort_by_parameter_order=True,
+        )
+        result = await _execute(db, statement, [row for _, row in rows])
+        for (instance, _), returned in zip(rows, result.all()):
+            values = {key: returned._mapping[column] for key, column in columns}
+            for key, value in values.items():
+                set_committed_value(instance, key, value)
+            existing = db.identity_map.get(mapper.identity_key_from_instance(instance))
+            if existing is not None and existing is not instance:
+                # the session already holds this row, so that object takes the upserted values
+                for key, value in values.items():
+                    set_committed_value(existing, key, value)
+                inserted.append((existing, values))
+                continue
+            if instance_state(instance).transient:
+                make_transient_to_detached(instance)
+            db.add(instance)
+            inserted.append((instance, values))
+    return inserted
+
+
+def _insert_statement(db: AsyncSession | Session, table: Table, keys: Sequence[str], upsert: bool) -> Any:
+    if not upsert:
+        return insert(table)
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        raise ValueError(f"upsert is not supported on {dialect}")
+    statement = dialect_insert(table)
+    primary_key = [column.key for column in table.primary_key]
+    values: dict[str, Any] = {key: statement.excluded[key] for key in keys if key not in primary_key}
+    for column in table.columns:
+        if column.key not in values and column.onupdate is not None and column.onupdate.is_clause_element:
+            values[column.key] = getattr(column.onupdate, "arg")
+    if not values:
+        # a no-op update still lets RETURNING produce the conflicting row
+        values = {primary_key[0]: statement.excluded[primary_key[0]]}
+    return statement.on_conflict_do_update(index_elements=primary_key, set_=values)